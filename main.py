@@ -1,12 +1,47 @@
 import os
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_from_directory
 import sqlite3
 import telebot
+import requests
 from telebot import types
 import logging
 from werkzeug.utils import secure_filename
 import hashlib
+import hmac
+import json
 import datetime
+import multiprocessing
+import time
+import threading
+import queue
+import collections
+import functools
+import re
+import unicodedata
+import contextlib
+import atexit
+import csv
+import io
+import heapq
+import itertools
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # PDF text search stays off until pypdf is installed
+    PdfReader = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # covers are sent as uploaded until Pillow is installed
+    Image = ImageOps = None
+
+try:
+    import pymupdf
+except ImportError:  # books without a cover get no PDF page preview
+    pymupdf = None
 
 # Configure logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -28,436 +63,2389 @@ os.makedirs(os.path.join(UPLOAD_FOLDER, 'books'), exist_ok=True)
 os.makedirs(os.path.join(UPLOAD_FOLDER, 'images'), exist_ok=True)
 
 # Initialize Telegram bot
-BOT_TOKEN = "Bot_token"  # Replace with your actual token
-bot = telebot.TeleBot(BOT_TOKEN)
+BOT_TOKEN = os.environ.get('BOT_TOKEN', "Bot_token")  # Replace with your actual token
+# Handlers run inline on the update workers below, which keep per-chat ordering
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', f"https://your-server-domain.com/{BOT_TOKEN}")
+
+# HTTP sessions
+# Bot API calls reuse keep-alive connections from a pool sized to the sender
+# workers below. Uploads and downloads of files get their own pool and a
+# longer read timeout, so a slow transfer never holds a connection that
+# small calls are waiting for. Only failed connection attempts are retried;
+# a request that may have reached Telegram is never sent twice.
+API_CONNECT_TIMEOUT = float(os.environ.get('API_CONNECT_TIMEOUT', 5))
+API_READ_TIMEOUT = float(os.environ.get('API_READ_TIMEOUT', 15))
+FILE_READ_TIMEOUT = float(os.environ.get('FILE_READ_TIMEOUT', 120))
+# Threads that perform queued Bot API calls (see the scheduler below)
+SEND_WORKERS = int(os.environ.get('SEND_WORKERS', 8))
+# One connection per sender plus a few for polling and file lookups
+API_POOL_SIZE = int(os.environ.get('API_POOL_SIZE', SEND_WORKERS + 4))
+FILE_POOL_SIZE = int(os.environ.get('FILE_POOL_SIZE', 4))
+
+def _pooled_session(pool_size):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        max_retries=requests.adapters.Retry(total=None, connect=2, read=0, status=0, other=0, backoff_factor=0.5)
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+_api_session = _pooled_session(API_POOL_SIZE)
+_file_session = _pooled_session(FILE_POOL_SIZE)
+
+telebot.apihelper.CONNECT_TIMEOUT = API_CONNECT_TIMEOUT
+telebot.apihelper.READ_TIMEOUT = API_READ_TIMEOUT
+
+def _api_request(method, url, **kwargs):
+    """Send a Bot API request on the matching pool."""
+    if kwargs.get('files'):
+        connect_timeout, read_timeout = kwargs.get('timeout') or (API_CONNECT_TIMEOUT, API_READ_TIMEOUT)
+        kwargs['timeout'] = (connect_timeout, max(read_timeout, FILE_READ_TIMEOUT))
+        return _file_session.request(method, url, **kwargs)
+    return _api_session.request(method, url, **kwargs)
+
+# Outbound API scheduler
+# Every Bot API call telebot makes goes through _send_api_request. Calls are
+# queued by priority (callback and inline answers first, then edits, then new
+# messages) and released by a dispatcher thread once both the global token
+# bucket and the target chat's bucket allow it. A chat has at most one call in
+# flight, so its messages keep their order; its other calls wait in a per-chat
+# heap and only the next one sits in the shared queue. A 429 reply pauses that chat (or
+# everything, for calls without a chat) for retry_after seconds and the call
+# is queued again. Polling, file lookups and webhook management bypass the
+# queue.
+SEND_GLOBAL_RATE = float(os.environ.get('SEND_GLOBAL_RATE', 30))
+SEND_CHAT_RATE = float(os.environ.get('SEND_CHAT_RATE', 1))
+SEND_GROUP_RATE = float(os.environ.get('SEND_GROUP_RATE', 20 / 60))
+SEND_CHAT_BURST = int(os.environ.get('SEND_CHAT_BURST', 3))
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', 3))
+SEND_CHAT_BUCKETS_MAX = 4096
+
+SEND_UNQUEUED_METHODS = {'getUpdates', 'getFile', 'getMe', 'setWebhook', 'deleteWebhook', 'getWebhookInfo', 'logOut', 'close'}
+SEND_PRIORITIES = {
+    'answerCallbackQuery': 0, 'answerInlineQuery': 0,
+    'editMessageText': 1, 'editMessageCaption': 1, 'editMessageMedia': 1,
+    'editMessageReplyMarkup': 1, 'deleteMessage': 1,
+}
+SEND_DEFAULT_PRIORITY = 2
+
+class TokenBucket:
+    """Allows rate calls per second on average, in bursts of up to capacity.
+
+    Not thread-safe; the scheduler only touches buckets under its lock.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now):
+        """Return how many seconds until a call may be made (0 if one may be made now)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+_send_condition = threading.Condition()
+_send_queue = []
+_send_sequence = itertools.count()
+_send_global_bucket = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+_send_chat_buckets = {}
+_send_busy_chats = set()
+_send_queued_chats = set()
+_send_chat_queues = {}
+_send_dispatcher = None
+_send_executor = ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix='api-send')
+_send_metrics = {'sent': 0, 'failed': 0, 'retried': 0, 'rate_limited': 0, 'wait_total': 0.0, 'max_wait': 0.0}
+
+def _chat_bucket(chat_id):
+    bucket = _send_chat_buckets.get(chat_id)
+    if bucket is None:
+        # Negative ids are groups and channels, which have a lower limit
+        rate = SEND_GROUP_RATE if str(chat_id).startswith('-') else SEND_CHAT_RATE
+        bucket = _send_chat_buckets[chat_id] = TokenBucket(rate, SEND_CHAT_BURST)
+    return bucket
+
+def _prune_chat_buckets(now):
+    for chat_id, bucket in list(_send_chat_buckets.items()):
+        if chat_id not in _send_busy_chats and bucket.delay(now) == 0 and bucket.tokens >= bucket.capacity:
+            del _send_chat_buckets[chat_id]
+
+def _queue_send_job(job):
+    """Queue a call; the caller holds _send_condition."""
+    entry = (job['priority'], job['sequence'], job)
+    chat_id = job['chat_id']
+    if chat_id is None:
+        heapq.heappush(_send_queue, entry)
+    elif chat_id in _send_busy_chats or chat_id in _send_queued_chats:
+        heapq.heappush(_send_chat_queues.setdefault(chat_id, []), entry)
+    else:
+        heapq.heappush(_send_queue, entry)
+        _send_queued_chats.add(chat_id)
+
+def _release_chat(chat_id):
+    """Mark a chat idle and move its next call to the shared queue; the caller holds _send_condition."""
+    _send_busy_chats.discard(chat_id)
+    waiting = _send_chat_queues.get(chat_id)
+    if waiting:
+        heapq.heappush(_send_queue, heapq.heappop(waiting))
+        _send_queued_chats.add(chat_id)
+        if not waiting:
+            del _send_chat_queues[chat_id]
+
+def _next_send_job():
+    """Pop the first queued call that may go out now; otherwise return (None, seconds to wait)."""
+    now = time.monotonic()
+    global_delay = _send_global_bucket.delay(now)
+    if global_delay:
+        return None, global_delay
+
+    # Calls for chats that are still rate limited are set aside and pushed
+    # back; there is at most one per chat in the shared queue.
+    wait = None
+    job = None
+    held = []
+    while _send_queue:
+        entry = heapq.heappop(_send_queue)
+        chat_id = entry[2]['chat_id']
+        delay = _chat_bucket(chat_id).delay(now) if chat_id is not None else 0.0
+        if delay:
+            wait = delay if wait is None else min(wait, delay)
+            held.append(entry)
+            continue
+        job = entry[2]
+        break
+
+    for entry in held:
+        heapq.heappush(_send_queue, entry)
+
+    if job is None:
+        return None, wait
+
+    _send_global_bucket.take()
+    if job['chat_id'] is not None:
+        _chat_bucket(job['chat_id']).take()
+        _send_queued_chats.discard(job['chat_id'])
+        _send_busy_chats.add(job['chat_id'])
+    return job, None
+
+def _send_dispatch_loop():
+    while True:
+        with _send_condition:
+            job, wait = _next_send_job()
+            if job is None:
+                _send_condition.wait(wait)
+                continue
+            if len(_send_chat_buckets) > SEND_CHAT_BUCKETS_MAX:
+                _prune_chat_buckets(time.monotonic())
+        _send_executor.submit(_perform_send, job)
+
+def _retry_after(response):
+    try:
+        return float(response.json()['parameters']['retry_after'])
+    except Exception:
+        return 1.0
 
-# Database initialization
-def init_db():
-    conn = sqlite3.connect('library.db')
-    cursor = conn.cursor()
-    
-    # Create users table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        first_name TEXT,
-        last_name TEXT,
-        role TEXT DEFAULT 'user',
-        registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+def _perform_send(job):
+    waited = time.monotonic() - job['queued_at']
+    try:
+        response = _api_request(job['method'], job['url'], **job['kwargs'])
+    except Exception as e:
+        _finish_send(job, waited, error=e)
+        return
+
+    if response.status_code == 429 and job['attempts'] < SEND_MAX_RETRIES:
+        retry_after = _retry_after(response)
+        logger.warning(f"Rate limited on {job['method_name']}, retrying in {retry_after}s")
+        with _send_condition:
+            bucket = _chat_bucket(job['chat_id']) if job['chat_id'] is not None else _send_global_bucket
+            bucket.pause(retry_after)
+            _send_metrics['rate_limited'] += 1
+            _send_metrics['retried'] += 1
+            job['attempts'] += 1
+            # Uploads are sent again from where they started
+            for file, position in job['file_positions']:
+                file.seek(position)
+            # Requeued with its original sequence, ahead of later calls to the chat
+            _queue_send_job(job)
+            _release_chat(job['chat_id'])
+            _send_condition.notify()
+        return
+
+    _finish_send(job, waited, response=response)
+
+def _finish_send(job, waited, response=None, error=None):
+    with _send_condition:
+        _release_chat(job['chat_id'])
+        _send_metrics['failed' if error is not None or response.status_code != 200 else 'sent'] += 1
+        if response is not None and response.status_code == 429:
+            _send_metrics['rate_limited'] += 1
+        _send_metrics['wait_total'] += waited
+        _send_metrics['max_wait'] = max(_send_metrics['max_wait'], waited)
+        _send_condition.notify()
+
+    if error is not None:
+        job['future'].set_exception(error)
+    else:
+        job['future'].set_result(response)
+
+def _send_api_request(method, url, **kwargs):
+    """telebot CUSTOM_REQUEST_SENDER: queue the call and wait for its response."""
+    global _send_dispatcher
+
+    method_name = url.rsplit('/', 1)[-1]
+    if method_name in SEND_UNQUEUED_METHODS:
+        return _api_request(method, url, **kwargs)
+
+    if _send_dispatcher is None or not _send_dispatcher.is_alive():
+        with _send_condition:
+            if _send_dispatcher is None or not _send_dispatcher.is_alive():
+                _send_dispatcher = threading.Thread(target=_send_dispatch_loop, name='api-dispatcher', daemon=True)
+                _send_dispatcher.start()
+
+    params = kwargs.get('params') or {}
+    files = [value[1] if isinstance(value, tuple) else value for value in (kwargs.get('files') or {}).values()]
+    job = {
+        'method': method,
+        'url': url,
+        'kwargs': kwargs,
+        'method_name': method_name,
+        'chat_id': params.get('chat_id'),
+        'priority': SEND_PRIORITIES.get(method_name, SEND_DEFAULT_PRIORITY),
+        'sequence': next(_send_sequence),
+        'file_positions': [(file, file.tell()) for file in files if hasattr(file, 'seek')],
+        'attempts': 0,
+        'queued_at': time.monotonic(),
+        'future': Future(),
+    }
+
+    with _send_condition:
+        _queue_send_job(job)
+        _send_condition.notify()
+
+    return job['future'].result()
+
+def get_send_metrics():
+    with _send_condition:
+        metrics = dict(_send_metrics)
+        queued = list(_send_queue)
+        for waiting in _send_chat_queues.values():
+            queued.extend(waiting)
+        lanes = collections.Counter(priority for priority, _, _ in queued)
+        metrics['queue_depth'] = len(queued)
+        metrics['in_flight'] = len(_send_busy_chats)
+    metrics['lane_depths'] = {'answers': lanes[0], 'edits': lanes[1], 'messages': lanes[2]}
+    completed = metrics['sent'] + metrics['failed']
+    metrics['avg_wait'] = metrics['wait_total'] / completed if completed else 0.0
+    return metrics
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = _send_api_request
+
+# Database connection pool
+# Connections are reused across handlers instead of being opened per call; each
+# one keeps its own prepared statement cache. A thread holds at most one
+# connection at a time, so nested helpers share it.
+DATABASE_PATH = os.environ.get('LIBRARY_DB', 'library.db')
+DB_POOL_SIZE = int(os.environ.get('LIBRARY_DB_POOL_SIZE', 8))
+DB_STATEMENT_CACHE_SIZE = 256
+DB_BUSY_TIMEOUT = float(os.environ.get('LIBRARY_DB_BUSY_TIMEOUT', 10))
+DB_WRITE_BATCH_SIZE = int(os.environ.get('LIBRARY_DB_WRITE_BATCH', 64))
+
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+_db_local = threading.local()
+
+def _connect():
+    conn = sqlite3.connect(
+        DATABASE_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE_SIZE
     )
-    ''')
-    
-    # Create books table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS books (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        title TEXT NOT NULL,
-        author TEXT NOT NULL,
-        description TEXT,
-        category TEXT,
-        image_path TEXT,
-        pdf_path TEXT,
-        added_by INTEGER,
-        add_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (added_by) REFERENCES users (user_id)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+@contextlib.contextmanager
+def db_connection():
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None:
+        # Already checked out by this thread
+        yield conn
+        return
+
+    try:
+        conn = _db_pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+
+    _db_local.conn = conn
+    try:
+        yield conn
+    finally:
+        _db_local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _db_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def close_db_pool():
+    while True:
+        try:
+            _db_pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+atexit.register(close_db_pool)
+
+# Database writer
+# Every mutation runs on one dedicated thread so handler threads never wait on
+# each other's locks. Queued writes are applied in batches inside a single
+# transaction; each write gets its own savepoint, so a failing one is rolled
+# back without discarding the rest of the batch.
+_write_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+def _writer_loop():
+    conn = _connect()
+    conn.isolation_level = None
+    cursor = conn.cursor()
+
+    while True:
+        batch = [_write_queue.get()]
+        while len(batch) < DB_WRITE_BATCH_SIZE:
+            try:
+                batch.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        stop = None in batch
+        batch = [job for job in batch if job is not None]
+        outcomes = []
+
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for func, args, future in batch:
+                cursor.execute("SAVEPOINT write_job")
+                try:
+                    outcomes.append((future, func(cursor, *args), None))
+                    cursor.execute("RELEASE write_job")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO write_job")
+                    cursor.execute("RELEASE write_job")
+                    outcomes.append((future, None, e))
+            cursor.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error(f"Database error: {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            outcomes = [(future, None, e) for _, _, future in batch]
+
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        if stop:
+            break
+
+    conn.close()
+
+def submit_write(func, *args):
+    """Queue func(cursor, *args) for the writer thread and return a Future."""
+    global _writer_thread
+
+    if _writer_thread is None or not _writer_thread.is_alive():
+        with _writer_lock:
+            if _writer_thread is None or not _writer_thread.is_alive():
+                _writer_thread = threading.Thread(target=_writer_loop, name='db-writer', daemon=True)
+                _writer_thread.start()
+
+    future = Future()
+    _write_queue.put((func, args, future))
+    return future
+
+def run_write(func, *args):
+    return submit_write(func, *args).result()
+
+def stop_db_writer():
+    if _writer_thread is not None and _writer_thread.is_alive():
+        _write_queue.put(None)
+        _writer_thread.join()
+
+# Registered after close_db_pool so queued writes are flushed first
+atexit.register(stop_db_writer)
+
+# Schema migrations
+# Entry N upgrades the schema to version N; PRAGMA user_version records the
+# last version applied. Append new migrations, never edit applied ones.
+# Entries are SQL scripts or callables taking the migration connection.
+def _split_sql(script):
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ''
+
+def _execute_script(conn, script):
+    # Unlike executescript(), this keeps the surrounding transaction open
+    for statement in _split_sql(script):
+        conn.execute(statement)
+
+def _migrate_search_keys(conn):
+    # Normalized search keys with a trigram index for substring and fuzzy matching
+    conn.execute("ALTER TABLE books ADD COLUMN search_key TEXT")
+
+    books = conn.execute("SELECT id, title, author, category FROM books").fetchall()
+    conn.executemany(
+        "UPDATE books SET search_key = ? WHERE id = ?",
+        [(build_search_key(title, author, category), book_id) for book_id, title, author, category in books]
     )
+
+    _execute_script(conn, '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS books_trigram USING fts5 (
+        search_key,
+        content='books', content_rowid='id',
+        tokenize='trigram'
+    );
+
+    INSERT INTO books_trigram (books_trigram) VALUES ('rebuild');
+
+    CREATE TRIGGER IF NOT EXISTS books_trigram_insert AFTER INSERT ON books BEGIN
+        INSERT INTO books_trigram (rowid, search_key) VALUES (new.id, new.search_key);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_trigram_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_trigram (books_trigram, rowid, search_key) VALUES ('delete', old.id, old.search_key);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_trigram_update AFTER UPDATE OF search_key ON books BEGIN
+        INSERT INTO books_trigram (books_trigram, rowid, search_key) VALUES ('delete', old.id, old.search_key);
+        INSERT INTO books_trigram (rowid, search_key) VALUES (new.id, new.search_key);
+    END;
     ''')
-    
-    # Create ratings table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS ratings (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        book_id INTEGER,
-        user_id INTEGER,
-        rating INTEGER,
-        comment TEXT,
-        date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (book_id) REFERENCES books (id),
-        FOREIGN KEY (user_id) REFERENCES users (user_id)
+
+MIGRATIONS = [
+    # 1: lookup indexes, one favorite / rating per user and book
+    '''
+    DELETE FROM favorites
+    WHERE id NOT IN (SELECT MIN(id) FROM favorites GROUP BY user_id, book_id);
+
+    DELETE FROM ratings
+    WHERE id NOT IN (SELECT MAX(id) FROM ratings GROUP BY user_id, book_id);
+
+    -- Also serves favorites lookups by user_id
+    CREATE UNIQUE INDEX IF NOT EXISTS ux_favorites_user_book ON favorites (user_id, book_id);
+    CREATE INDEX IF NOT EXISTS idx_favorites_book ON favorites (book_id);
+    CREATE UNIQUE INDEX IF NOT EXISTS ux_ratings_user_book ON ratings (user_id, book_id);
+    CREATE INDEX IF NOT EXISTS idx_ratings_book ON ratings (book_id, date);
+    CREATE INDEX IF NOT EXISTS idx_books_category ON books (category);
+    CREATE INDEX IF NOT EXISTS idx_users_role ON users (role);
+    ''',
+    # 2: update ids already accepted, shared between processes
+    '''
+    CREATE TABLE IF NOT EXISTS processed_updates (
+        update_id INTEGER PRIMARY KEY,
+        received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ''',
+    # 3: Telegram file_ids of uploaded covers and PDFs
+    '''
+    CREATE TABLE IF NOT EXISTS telegram_files (
+        book_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        file_hash TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (book_id, kind),
+        FOREIGN KEY (book_id) REFERENCES books (id)
+    );
+    ''',
+    # 4: full-text index over books, kept in sync by triggers
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5 (
+        title, author, description, category,
+        content='books', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    );
+
+    INSERT INTO books_fts (books_fts) VALUES ('rebuild');
+
+    CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts (rowid, title, author, description, category)
+        VALUES (new.id, new.title, new.author, new.description, new.category);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts (books_fts, rowid, title, author, description, category)
+        VALUES ('delete', old.id, old.title, old.author, old.description, old.category);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author, description, category ON books BEGIN
+        INSERT INTO books_fts (books_fts, rowid, title, author, description, category)
+        VALUES ('delete', old.id, old.title, old.author, old.description, old.category);
+        INSERT INTO books_fts (rowid, title, author, description, category)
+        VALUES (new.id, new.title, new.author, new.description, new.category);
+    END;
+    ''',
+    # 5: text extracted from book PDFs, chunked and full-text indexed
+    '''
+    ALTER TABLE books ADD COLUMN page_count INTEGER;
+    -- NULL until the PDF text is indexed, then 'done' or 'failed'
+    ALTER TABLE books ADD COLUMN text_status TEXT;
+
+    CREATE TABLE IF NOT EXISTS book_text_chunks (
+        id INTEGER PRIMARY KEY,
+        book_id INTEGER NOT NULL,
+        page INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        FOREIGN KEY (book_id) REFERENCES books (id)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_book_text_chunks_book ON book_text_chunks (book_id);
+    CREATE INDEX IF NOT EXISTS idx_books_text_pending ON books (id) WHERE text_status IS NULL;
+
+    CREATE VIRTUAL TABLE IF NOT EXISTS book_text_fts USING fts5 (
+        content,
+        content='book_text_chunks', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS book_text_fts_insert AFTER INSERT ON book_text_chunks BEGIN
+        INSERT INTO book_text_fts (rowid, content) VALUES (new.id, new.content);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS book_text_fts_delete AFTER DELETE ON book_text_chunks BEGIN
+        INSERT INTO book_text_fts (book_text_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_text_delete AFTER DELETE ON books BEGIN
+        DELETE FROM book_text_chunks WHERE book_id = old.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_text_reset AFTER UPDATE OF pdf_path ON books
+    WHEN new.pdf_path IS NOT old.pdf_path BEGIN
+        UPDATE books SET text_status = NULL, page_count = NULL WHERE id = new.id;
+    END;
+    ''',
+    # 6: transliterated search keys and their trigram index
+    _migrate_search_keys,
+    # 7: per-book rating count, sum and histogram, kept current by triggers
+    '''
+    CREATE TABLE IF NOT EXISTS book_rating_stats (
+        book_id INTEGER PRIMARY KEY,
+        rating_count INTEGER NOT NULL DEFAULT 0,
+        rating_sum INTEGER NOT NULL DEFAULT 0,
+        rating_1 INTEGER NOT NULL DEFAULT 0,
+        rating_2 INTEGER NOT NULL DEFAULT 0,
+        rating_3 INTEGER NOT NULL DEFAULT 0,
+        rating_4 INTEGER NOT NULL DEFAULT 0,
+        rating_5 INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (book_id) REFERENCES books (id)
+    );
+
+    INSERT INTO book_rating_stats (book_id, rating_count, rating_sum, rating_1, rating_2, rating_3, rating_4, rating_5)
+    SELECT book_id, COUNT(*), SUM(rating),
+           SUM(rating = 1), SUM(rating = 2), SUM(rating = 3), SUM(rating = 4), SUM(rating = 5)
+    FROM ratings
+    WHERE book_id IS NOT NULL AND rating IS NOT NULL
+    GROUP BY book_id;
+
+    CREATE TRIGGER IF NOT EXISTS ratings_stats_insert AFTER INSERT ON ratings
+    WHEN new.rating IS NOT NULL BEGIN
+        INSERT OR IGNORE INTO book_rating_stats (book_id) VALUES (new.book_id);
+        UPDATE book_rating_stats
+        SET rating_count = rating_count + 1, rating_sum = rating_sum + new.rating,
+            rating_1 = rating_1 + (new.rating = 1), rating_2 = rating_2 + (new.rating = 2),
+            rating_3 = rating_3 + (new.rating = 3), rating_4 = rating_4 + (new.rating = 4),
+            rating_5 = rating_5 + (new.rating = 5)
+        WHERE book_id = new.book_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS ratings_stats_delete AFTER DELETE ON ratings
+    WHEN old.rating IS NOT NULL BEGIN
+        UPDATE book_rating_stats
+        SET rating_count = rating_count - 1, rating_sum = rating_sum - old.rating,
+            rating_1 = rating_1 - (old.rating = 1), rating_2 = rating_2 - (old.rating = 2),
+            rating_3 = rating_3 - (old.rating = 3), rating_4 = rating_4 - (old.rating = 4),
+            rating_5 = rating_5 - (old.rating = 5)
+        WHERE book_id = old.book_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS ratings_stats_update AFTER UPDATE OF rating, book_id ON ratings BEGIN
+        UPDATE book_rating_stats
+        SET rating_count = rating_count - 1, rating_sum = rating_sum - old.rating,
+            rating_1 = rating_1 - (old.rating = 1), rating_2 = rating_2 - (old.rating = 2),
+            rating_3 = rating_3 - (old.rating = 3), rating_4 = rating_4 - (old.rating = 4),
+            rating_5 = rating_5 - (old.rating = 5)
+        WHERE book_id = old.book_id AND old.rating IS NOT NULL;
+        INSERT OR IGNORE INTO book_rating_stats (book_id) SELECT new.book_id WHERE new.rating IS NOT NULL;
+        UPDATE book_rating_stats
+        SET rating_count = rating_count + 1, rating_sum = rating_sum + new.rating,
+            rating_1 = rating_1 + (new.rating = 1), rating_2 = rating_2 + (new.rating = 2),
+            rating_3 = rating_3 + (new.rating = 3), rating_4 = rating_4 + (new.rating = 4),
+            rating_5 = rating_5 + (new.rating = 5)
+        WHERE book_id = new.book_id AND new.rating IS NOT NULL;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_rating_stats_delete AFTER DELETE ON books BEGIN
+        DELETE FROM book_rating_stats WHERE book_id = old.id;
+    END;
+
+    CREATE INDEX IF NOT EXISTS idx_book_rating_stats_rated ON book_rating_stats (book_id) WHERE rating_count > 0;
+    ''',
+    # 8: an upsert's conflict policy overrides INSERT OR IGNORE inside the
+    # triggers it fires, so create missing stats rows with NOT EXISTS instead
+    '''
+    DROP TRIGGER IF EXISTS ratings_stats_insert;
+    DROP TRIGGER IF EXISTS ratings_stats_update;
+
+    CREATE TRIGGER ratings_stats_insert AFTER INSERT ON ratings
+    WHEN new.rating IS NOT NULL BEGIN
+        INSERT INTO book_rating_stats (book_id)
+        SELECT new.book_id WHERE NOT EXISTS (SELECT 1 FROM book_rating_stats WHERE book_id = new.book_id);
+        UPDATE book_rating_stats
+        SET rating_count = rating_count + 1, rating_sum = rating_sum + new.rating,
+            rating_1 = rating_1 + (new.rating = 1), rating_2 = rating_2 + (new.rating = 2),
+            rating_3 = rating_3 + (new.rating = 3), rating_4 = rating_4 + (new.rating = 4),
+            rating_5 = rating_5 + (new.rating = 5)
+        WHERE book_id = new.book_id;
+    END;
+
+    CREATE TRIGGER ratings_stats_update AFTER UPDATE OF rating, book_id ON ratings BEGIN
+        UPDATE book_rating_stats
+        SET rating_count = rating_count - 1, rating_sum = rating_sum - old.rating,
+            rating_1 = rating_1 - (old.rating = 1), rating_2 = rating_2 - (old.rating = 2),
+            rating_3 = rating_3 - (old.rating = 3), rating_4 = rating_4 - (old.rating = 4),
+            rating_5 = rating_5 - (old.rating = 5)
+        WHERE book_id = old.book_id AND old.rating IS NOT NULL;
+        INSERT INTO book_rating_stats (book_id)
+        SELECT new.book_id WHERE new.rating IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM book_rating_stats WHERE book_id = new.book_id);
+        UPDATE book_rating_stats
+        SET rating_count = rating_count + 1, rating_sum = rating_sum + new.rating,
+            rating_1 = rating_1 + (new.rating = 1), rating_2 = rating_2 + (new.rating = 2),
+            rating_3 = rating_3 + (new.rating = 3), rating_4 = rating_4 + (new.rating = 4),
+            rating_5 = rating_5 + (new.rating = 5)
+        WHERE book_id = new.book_id AND new.rating IS NOT NULL;
+    END;
+    ''',
+    # 9: favorites listed newest first, a page at a time
+    '''
+    CREATE INDEX IF NOT EXISTS idx_favorites_user_date ON favorites (user_id, date_added, id);
+    ''',
+    # 10: users browsed newest first, optionally filtered by role
+    '''
+    CREATE INDEX IF NOT EXISTS idx_users_registration ON users (registration_date, user_id);
+    CREATE INDEX IF NOT EXISTS idx_users_role_registration ON users (role, registration_date, user_id);
+    ''',
+    # 11: version counters that tell in-process caches to drop their entries
+    '''
+    CREATE TABLE IF NOT EXISTS cache_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    );
+    INSERT OR IGNORE INTO cache_versions (name) VALUES ('roles');
+    CREATE TRIGGER IF NOT EXISTS users_role_version AFTER UPDATE OF role ON users
+    WHEN old.role IS NOT new.role BEGIN
+        UPDATE cache_versions SET version = version + 1 WHERE name = 'roles';
+    END;
+    ''',
+    # 12: statistics answered from precomputed values: running totals and
+    # per-day counts kept by triggers, plus a periodically refreshed snapshot
+    # of the aggregate listings (see refresh_stats_snapshot)
+    '''
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    );
+    INSERT OR REPLACE INTO stats_counters (name, value) VALUES
+        ('books', (SELECT COUNT(*) FROM books)),
+        ('users', (SELECT COUNT(*) FROM users)),
+        ('ratings', (SELECT COALESCE(SUM(rating_count), 0) FROM book_rating_stats));
+
+    CREATE TABLE IF NOT EXISTS stats_daily (
+        day TEXT PRIMARY KEY,
+        new_users INTEGER NOT NULL DEFAULT 0,
+        new_books INTEGER NOT NULL DEFAULT 0,
+        new_ratings INTEGER NOT NULL DEFAULT 0
+    );
+    INSERT OR REPLACE INTO stats_daily (day, new_users, new_books, new_ratings)
+    SELECT day, SUM(user), SUM(book), SUM(rating) FROM (
+        SELECT date(registration_date) AS day, 1 AS user, 0 AS book, 0 AS rating FROM users
+        UNION ALL SELECT date(add_date), 0, 1, 0 FROM books
+        UNION ALL SELECT date(date), 0, 0, 1 FROM ratings WHERE rating IS NOT NULL
     )
-    ''')
-    
-    # Create favorites table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS favorites (
+    WHERE day IS NOT NULL
+    GROUP BY day;
+
+    CREATE TABLE IF NOT EXISTS stats_snapshot (
+        name TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TRIGGER IF NOT EXISTS users_stats_insert AFTER INSERT ON users BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'users';
+        INSERT INTO stats_daily (day) SELECT date('now')
+        WHERE NOT EXISTS (SELECT 1 FROM stats_daily WHERE day = date('now'));
+        UPDATE stats_daily SET new_users = new_users + 1 WHERE day = date('now');
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS users_stats_delete AFTER DELETE ON users BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'users';
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_stats_insert AFTER INSERT ON books BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'books';
+        INSERT INTO stats_daily (day) SELECT date('now')
+        WHERE NOT EXISTS (SELECT 1 FROM stats_daily WHERE day = date('now'));
+        UPDATE stats_daily SET new_books = new_books + 1 WHERE day = date('now');
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_stats_delete AFTER DELETE ON books BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'books';
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS ratings_stats_daily AFTER INSERT ON ratings
+    WHEN new.rating IS NOT NULL BEGIN
+        INSERT INTO stats_daily (day) SELECT date('now')
+        WHERE NOT EXISTS (SELECT 1 FROM stats_daily WHERE day = date('now'));
+        UPDATE stats_daily SET new_ratings = new_ratings + 1 WHERE day = date('now');
+    END;
+
+    -- The ratings total follows the per-book counts, whatever changed them
+    CREATE TRIGGER IF NOT EXISTS rating_stats_total_update AFTER UPDATE OF rating_count ON book_rating_stats BEGIN
+        UPDATE stats_counters SET value = value + new.rating_count - old.rating_count WHERE name = 'ratings';
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS rating_stats_total_delete AFTER DELETE ON book_rating_stats BEGIN
+        UPDATE stats_counters SET value = value - old.rating_count WHERE name = 'ratings';
+    END;
+    ''',
+    # 13: categories as their own table with per-category book counts.
+    # books.category keeps the name for display and search; triggers keep it
+    # and books.category_id pointing at the same category, whichever is set.
+    '''
+    CREATE TABLE IF NOT EXISTS categories (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        book_id INTEGER,
-        date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (user_id),
-        FOREIGN KEY (book_id) REFERENCES books (id)
+        name TEXT NOT NULL UNIQUE,
+        book_count INTEGER NOT NULL DEFAULT 0
+    );
+    INSERT OR IGNORE INTO categories (name, book_count)
+    SELECT category, COUNT(*) FROM books
+    WHERE category IS NOT NULL AND category != ''
+    GROUP BY category;
+
+    ALTER TABLE books ADD COLUMN category_id INTEGER REFERENCES categories (id);
+    UPDATE books SET category_id = (SELECT id FROM categories WHERE name = books.category);
+    CREATE INDEX IF NOT EXISTS idx_books_category_id ON books (category_id, id);
+
+    CREATE TRIGGER IF NOT EXISTS books_category_insert AFTER INSERT ON books BEGIN
+        INSERT INTO categories (name) SELECT new.category
+        WHERE new.category != '' AND NOT EXISTS (SELECT 1 FROM categories WHERE name = new.category);
+        UPDATE books SET category_id = (SELECT id FROM categories WHERE name = new.category) WHERE id = new.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_category_update AFTER UPDATE OF category ON books
+    WHEN old.category IS NOT new.category BEGIN
+        INSERT INTO categories (name) SELECT new.category
+        WHERE new.category != '' AND NOT EXISTS (SELECT 1 FROM categories WHERE name = new.category);
+        UPDATE books SET category_id = (SELECT id FROM categories WHERE name = new.category) WHERE id = new.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_category_id_update AFTER UPDATE OF category_id ON books
+    WHEN old.category_id IS NOT new.category_id BEGIN
+        UPDATE categories SET book_count = book_count - 1 WHERE id = old.category_id;
+        UPDATE categories SET book_count = book_count + 1 WHERE id = new.category_id;
+        UPDATE books SET category = (SELECT name FROM categories WHERE id = new.category_id)
+        WHERE id = new.id AND new.category_id IS NOT NULL
+          AND category IS NOT (SELECT name FROM categories WHERE id = new.category_id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_category_delete AFTER DELETE ON books BEGIN
+        UPDATE categories SET book_count = book_count - 1 WHERE id = old.category_id;
+    END;
+    ''',
+    # 14: reference counts for stored upload files, kept by triggers on the
+    # books that point at them (see "Upload storage")
+    '''
+    CREATE TABLE IF NOT EXISTS stored_files (
+        path TEXT PRIMARY KEY,
+        ref_count INTEGER NOT NULL DEFAULT 0,
+        stored_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    INSERT OR IGNORE INTO stored_files (path, ref_count)
+    SELECT path, COUNT(*) FROM (
+        SELECT image_path AS path FROM books
+        UNION ALL SELECT pdf_path FROM books
     )
-    ''')
-    
-    # Create the first superadmin if not exists
-    cursor.execute("SELECT * FROM users WHERE role = 'superadmin'")
-    if not cursor.fetchone():
-        # Set your superadmin chat ID here
-        superadmin_id =  123456 #super admin uchun chat ID
+    WHERE path IS NOT NULL AND path != ''
+    GROUP BY path;
+
+    CREATE TRIGGER IF NOT EXISTS books_files_insert AFTER INSERT ON books BEGIN
+        INSERT INTO stored_files (path) SELECT new.image_path
+        WHERE new.image_path != '' AND NOT EXISTS (SELECT 1 FROM stored_files WHERE path = new.image_path);
+        UPDATE stored_files SET ref_count = ref_count + 1 WHERE path = new.image_path;
+        INSERT INTO stored_files (path) SELECT new.pdf_path
+        WHERE new.pdf_path != '' AND NOT EXISTS (SELECT 1 FROM stored_files WHERE path = new.pdf_path);
+        UPDATE stored_files SET ref_count = ref_count + 1 WHERE path = new.pdf_path;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_files_image_update AFTER UPDATE OF image_path ON books
+    WHEN old.image_path IS NOT new.image_path BEGIN
+        UPDATE stored_files SET ref_count = ref_count - 1 WHERE path = old.image_path;
+        INSERT INTO stored_files (path) SELECT new.image_path
+        WHERE new.image_path != '' AND NOT EXISTS (SELECT 1 FROM stored_files WHERE path = new.image_path);
+        UPDATE stored_files SET ref_count = ref_count + 1 WHERE path = new.image_path;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_files_pdf_update AFTER UPDATE OF pdf_path ON books
+    WHEN old.pdf_path IS NOT new.pdf_path BEGIN
+        UPDATE stored_files SET ref_count = ref_count - 1 WHERE path = old.pdf_path;
+        INSERT INTO stored_files (path) SELECT new.pdf_path
+        WHERE new.pdf_path != '' AND NOT EXISTS (SELECT 1 FROM stored_files WHERE path = new.pdf_path);
+        UPDATE stored_files SET ref_count = ref_count + 1 WHERE path = new.pdf_path;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_files_delete AFTER DELETE ON books BEGIN
+        UPDATE stored_files SET ref_count = ref_count - 1 WHERE path IN (old.image_path, old.pdf_path);
+    END;
+
+    CREATE INDEX IF NOT EXISTS idx_stored_files_unreferenced ON stored_files (stored_at) WHERE ref_count <= 0;
+    ''',
+    # 15: thumbnail and preview images derived from the cover or the PDF's
+    # first page; cleared when either source changes so they are rendered again
+    '''
+    ALTER TABLE books ADD COLUMN thumbnail_path TEXT;
+    ALTER TABLE books ADD COLUMN preview_path TEXT;
+
+    CREATE TRIGGER IF NOT EXISTS books_previews_reset AFTER UPDATE OF image_path, pdf_path ON books
+    WHEN old.image_path IS NOT new.image_path OR old.pdf_path IS NOT new.pdf_path BEGIN
+        UPDATE books SET thumbnail_path = NULL, preview_path = NULL WHERE id = new.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_files_thumbnail_update AFTER UPDATE OF thumbnail_path ON books
+    WHEN old.thumbnail_path IS NOT new.thumbnail_path BEGIN
+        UPDATE stored_files SET ref_count = ref_count - 1 WHERE path = old.thumbnail_path;
+        UPDATE stored_files SET ref_count = ref_count + 1 WHERE path = new.thumbnail_path;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_files_preview_update AFTER UPDATE OF preview_path ON books
+    WHEN old.preview_path IS NOT new.preview_path BEGIN
+        UPDATE stored_files SET ref_count = ref_count - 1 WHERE path = old.preview_path;
+        UPDATE stored_files SET ref_count = ref_count + 1 WHERE path = new.preview_path;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS books_files_previews_delete AFTER DELETE ON books BEGIN
+        UPDATE stored_files SET ref_count = ref_count - 1 WHERE path IN (old.thumbnail_path, old.preview_path);
+    END;
+    ''',
+    # 16: path and mtime of the file a cached file_id was uploaded from, so it
+    # can be checked against the book without hashing the file again
+    '''
+    ALTER TABLE telegram_files ADD COLUMN file_path TEXT;
+    ALTER TABLE telegram_files ADD COLUMN file_mtime_ns INTEGER;
+    ''',
+]
+
+def apply_migrations():
+    conn = _connect()
+    conn.isolation_level = None
+
+    try:
+        for version, migration in enumerate(MIGRATIONS, 1):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Re-read inside the transaction in case another process migrated first
+                if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    conn.execute("COMMIT")
+                    continue
+
+                logger.info(f"Applying database migration {version}")
+                if callable(migration):
+                    migration(conn)
+                else:
+                    _execute_script(conn, migration)
+
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.close()
+
+# Database initialization
+def init_db():
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        # WAL lets readers proceed while the writer thread commits
+        cursor.execute("PRAGMA journal_mode = WAL")
+
+        # Create users table
         cursor.execute('''
-        INSERT INTO users (user_id, username, first_name, last_name, role) 
-        VALUES (?, ?, ?, ?, ?)
-        ''', (superadmin_id, 'superadmin', 'Super', 'Admin', 'superadmin'))
-    
-    conn.commit()
-    conn.close()
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            role TEXT DEFAULT 'user',
+            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+
+        # Create books table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS books (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            description TEXT,
+            category TEXT,
+            image_path TEXT,
+            pdf_path TEXT,
+            added_by INTEGER,
+            add_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (added_by) REFERENCES users (user_id)
+        )
+        ''')
+
+        # Create ratings table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ratings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER,
+            user_id INTEGER,
+            rating INTEGER,
+            comment TEXT,
+            date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (book_id) REFERENCES books (id),
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''')
+
+        # Create favorites table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS favorites (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            book_id INTEGER,
+            date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (book_id) REFERENCES books (id)
+        )
+        ''')
+
+        # Create the first superadmin if not exists
+        cursor.execute("SELECT * FROM users WHERE role = 'superadmin'")
+        if not cursor.fetchone():
+            # Set your superadmin chat ID here
+            superadmin_id =  123456 #super admin uchun chat ID
+            cursor.execute('''
+            INSERT INTO users (user_id, username, first_name, last_name, role)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (superadmin_id, 'superadmin', 'Super', 'Admin', 'superadmin'))
+
+        conn.commit()
+
+    apply_migrations()
 
 # Helper function to check allowed file extensions
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# Helper function to get user role
-def get_user_role(user_id):
-    conn = sqlite3.connect('library.db')
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT role FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    
-    conn.close()
-    return result[0] if result else 'user'
-
 # Database data access functions
-def get_book_by_id(book_id):
-    conn = sqlite3.connect('library.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT * FROM books WHERE id = ?
-    ''', (book_id,))
-    
-    book = cursor.fetchone()
-    conn.close()
-    
+def _load_book(book_id):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute('''
+        SELECT b.*,
+               COALESCE(s.rating_count, 0) AS rating_count, COALESCE(s.rating_sum, 0) AS rating_sum,
+               COALESCE(s.rating_1, 0) AS rating_1, COALESCE(s.rating_2, 0) AS rating_2,
+               COALESCE(s.rating_3, 0) AS rating_3, COALESCE(s.rating_4, 0) AS rating_4,
+               COALESCE(s.rating_5, 0) AS rating_5
+        FROM books b
+        LEFT JOIN book_rating_stats s ON s.book_id = b.id
+        WHERE b.id = ?
+        ''', (book_id,))
+
+        book = cursor.fetchone()
+
     return dict(book) if book else None
 
-def search_books(query):
-    conn = sqlite3.connect('library.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
+# Search text normalization
+# Uzbek is written in both Latin and Cyrillic, with several apostrophe
+# characters for o' and g'. Text is transliterated to Latin and case-folded;
+# search keys additionally drop apostrophes and punctuation.
+APOSTROPHES = "'‘’ʻʼ`´"
+CYRILLIC_TO_LATIN = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'ё': 'yo', 'ж': 'j', 'з': 'z',
+    'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p',
+    'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'x', 'ц': 'ts', 'ч': 'ch',
+    'ш': 'sh', 'щ': 'sh', 'ъ': "'", 'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+    'ў': "o'", 'қ': 'q', 'ғ': "g'", 'ҳ': 'h',
+    # Turkic-style Latin spellings
+    'ş': 'sh', 'ç': 'ch', 'ğ': "g'", 'ö': "o'",
+}
+SEARCH_MIN_SIMILARITY = 0.5
+SEARCH_FUZZY_CANDIDATES = 200
+
+def transliterate(text):
+    text = unicodedata.normalize('NFC', text or '').casefold()
+    result = []
+    for i, char in enumerate(text):
+        if char in APOSTROPHES:
+            result.append("'")
+        elif char == 'е':
+            # Cyrillic е reads "ye" at the start of a word and after a vowel
+            previous = text[i - 1] if i else ' '
+            result.append('ye' if not previous.isalpha() or previous in 'аеёиоуўэюяъь' else 'e')
+        else:
+            result.append(CYRILLIC_TO_LATIN.get(char, char))
+
+    # Strip any remaining diacritics
+    text = unicodedata.normalize('NFKD', ''.join(result))
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+def normalize_search_text(text):
+    text = transliterate(text).replace("'", '')
+    return ' '.join(re.findall(r'\w+', text))
+
+def build_search_key(title, author, category):
+    return ' '.join(normalize_search_text(part) for part in (title, author, category) if part)
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+# Helper function to turn user input into an FTS5 query: every word must
+# match, as a prefix, in any indexed column
+def build_fts_query(text):
+    return ' '.join(f'"{term}"*' for term in re.findall(r'\w+', text.lower()))
+
+def _search_exact(cursor, query, limit, offset):
+    raw_query = build_fts_query(query)
+    latin_query = build_fts_query(transliterate(query))
+    fts_query = raw_query if latin_query == raw_query else f"({raw_query}) OR ({latin_query})"
+    # Trigram phrases match anywhere inside the normalized key, but need 3+ characters
+    key_query = ' '.join(f'"{word}"' for word in normalize_search_text(query).split() if len(word) >= 3)
+
+    hits = []
+    if key_query:
+        hits.append('''
+            SELECT rowid AS book_id, bm25(books_trigram) - 1000 AS score, NULL AS snippet
+            FROM books_trigram
+            WHERE books_trigram MATCH :key_query
+        ''')
+    if raw_query:
+        hits.append('''
+            SELECT rowid AS book_id, bm25(books_fts, 10.0, 5.0, 1.0, 2.0) AS score, NULL AS snippet
+            FROM books_fts
+            WHERE books_fts MATCH :fts_query
+        ''')
+        hits.append('''
+            SELECT c.book_id, 1000000 + bm25(book_text_fts), snippet(book_text_fts, 0, '', '', '…', 12)
+            FROM book_text_fts
+            JOIN book_text_chunks c ON c.id = book_text_fts.rowid
+            WHERE book_text_fts MATCH :fts_query
+        ''')
+    if not hits:
+        return []
+
+    # Normalized title/author/category matches come first, then raw matches
+    # weighted by column, then books that only match inside their PDF text,
+    # with a snippet of the best matching chunk.
+    cursor.execute(f'''
+    SELECT b.*, hits.snippet, MIN(hits.score) AS score FROM (
+        {' UNION ALL '.join(hits)}
+    ) hits
+    JOIN books b ON b.id = hits.book_id
+    GROUP BY b.id
+    ORDER BY score, b.id
+    LIMIT :limit OFFSET :offset
+    ''', {'key_query': key_query, 'fts_query': fts_query, 'limit': limit, 'offset': offset})
+
+    return [dict(row) for row in cursor.fetchall()]
+
+def _search_fuzzy(cursor, query, limit, offset):
+    # Typo tolerance: candidates sharing any trigram with the query, kept when
+    # enough of the query's trigrams occur in their search key
+    query_trigrams = _trigrams(normalize_search_text(query))
+    if not query_trigrams:
+        return []
+
     cursor.execute('''
-    SELECT * FROM books 
-    WHERE title LIKE ? OR author LIKE ?
-    ''', (f'%{query}%', f'%{query}%'))
-    
-    books = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
+    SELECT rowid, search_key FROM books_trigram
+    WHERE books_trigram MATCH ?
+    ORDER BY bm25(books_trigram)
+    LIMIT ?
+    ''', (' OR '.join(f'"{trigram}"' for trigram in query_trigrams), SEARCH_FUZZY_CANDIDATES))
+
+    scored = []
+    for book_id, search_key in cursor.fetchall():
+        similarity = len(query_trigrams & _trigrams(search_key or '')) / len(query_trigrams)
+        if similarity >= SEARCH_MIN_SIMILARITY:
+            scored.append((-similarity, book_id))
+
+    scored.sort()
+    book_ids = [book_id for _, book_id in scored]
+    book_ids = book_ids[offset:] if limit < 0 else book_ids[offset:offset + limit]
+    return _fetch_books(cursor, book_ids)
+
+def _fetch_books(cursor, book_ids):
+    # Rows for the given ids, in the same order
+    if not book_ids:
+        return []
+
+    cursor.execute(f"SELECT * FROM books WHERE id IN ({','.join('?' * len(book_ids))})", book_ids)
+    books = {row['id']: dict(row) for row in cursor.fetchall()}
+    return [books[book_id] for book_id in book_ids if book_id in books]
+
+def get_books_by_ids(book_ids):
+    with db_connection() as conn:
+        books = _fetch_books(conn.cursor(), book_ids)
+
     return books
 
-def get_books_by_category(category):
-    conn = sqlite3.connect('library.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT * FROM books WHERE category = ?
-    ''', (category,))
-    
-    books = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
+def search_books(query, limit=-1, offset=0):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        books = _search_exact(cursor, query, limit, offset)
+
+        # Fall back to fuzzy matching only when nothing matched at all
+        if not books and (offset == 0 or not _search_exact(cursor, query, 1, 0)):
+            books = _search_fuzzy(cursor, query, limit, offset)
+
     return books
 
-def get_user_favorites(user_id):
-    conn = sqlite3.connect('library.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT b.* FROM books b
-    JOIN favorites f ON b.id = f.book_id
-    WHERE f.user_id = ?
-    ''', (user_id,))
-    
-    books = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
+def get_books_by_category(category_id, limit=-1, offset=0):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute('''
+        SELECT * FROM books WHERE category_id = ?
+        ORDER BY id
+        LIMIT ? OFFSET ?
+        ''', (category_id, limit, offset))
+
+        books = [dict(row) for row in cursor.fetchall()]
+
     return books
 
+def count_user_favorites(user_id):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT COUNT(*) FROM favorites WHERE user_id = ?", (user_id,))
+        count = cursor.fetchone()[0]
+
+    return count
+
+def get_favorites_page(user_id, older_than=None, newer_than=None, limit=10):
+    """Return one page of favorites, newest first, plus whether newer and older ones exist.
+
+    Pages are keyset-paginated on (date_added, id): older_than / newer_than
+    are the keys of the favorite just outside the page.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        if newer_than:
+            cursor.execute('''
+            SELECT b.*, f.id AS favorite_id, f.date_added FROM favorites f
+            JOIN books b ON b.id = f.book_id
+            WHERE f.user_id = ? AND (f.date_added, f.id) > (?, ?)
+            ORDER BY f.date_added, f.id
+            LIMIT ?
+            ''', (user_id, *newer_than, limit))
+            books = [dict(row) for row in reversed(cursor.fetchall())]
+        elif older_than:
+            cursor.execute('''
+            SELECT b.*, f.id AS favorite_id, f.date_added FROM favorites f
+            JOIN books b ON b.id = f.book_id
+            WHERE f.user_id = ? AND (f.date_added, f.id) < (?, ?)
+            ORDER BY f.date_added DESC, f.id DESC
+            LIMIT ?
+            ''', (user_id, *older_than, limit))
+            books = [dict(row) for row in cursor.fetchall()]
+        else:
+            cursor.execute('''
+            SELECT b.*, f.id AS favorite_id, f.date_added FROM favorites f
+            JOIN books b ON b.id = f.book_id
+            WHERE f.user_id = ?
+            ORDER BY f.date_added DESC, f.id DESC
+            LIMIT ?
+            ''', (user_id, limit))
+            books = [dict(row) for row in cursor.fetchall()]
+
+        if not books:
+            return books, False, False
+
+        cursor.execute('''
+        SELECT EXISTS (SELECT 1 FROM favorites WHERE user_id = ? AND (date_added, id) > (?, ?)),
+               EXISTS (SELECT 1 FROM favorites WHERE user_id = ? AND (date_added, id) < (?, ?))
+        ''', (user_id, books[0]['date_added'], books[0]['favorite_id'],
+              user_id, books[-1]['date_added'], books[-1]['favorite_id']))
+        has_newer, has_older = cursor.fetchone()
+
+    return books, bool(has_newer), bool(has_older)
+
 def add_to_favorites(user_id, book_id):
-    conn = sqlite3.connect('library.db')
-    cursor = conn.cursor()
-    
-    try:
+    def write(cursor):
         cursor.execute('''
         INSERT INTO favorites (user_id, book_id) VALUES (?, ?)
+        ON CONFLICT (user_id, book_id) DO NOTHING
         ''', (user_id, book_id))
-        conn.commit()
+
+        return cursor.rowcount == 1
+
+    try:
+        added = run_write(write)
         success = True
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
-        conn.rollback()
+        added = False
         success = False
-    
-    conn.close()
-    return success
+
+    return success, added
 
 def remove_from_favorites(user_id, book_id):
-    conn = sqlite3.connect('library.db')
-    cursor = conn.cursor()
-    
-    try:
+    def write(cursor):
         cursor.execute('''
         DELETE FROM favorites WHERE user_id = ? AND book_id = ?
         ''', (user_id, book_id))
-        conn.commit()
+
+    try:
+        run_write(write)
         success = True
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
-        conn.rollback()
         success = False
-    
-    conn.close()
+
     return success
 
 def add_rating(user_id, book_id, rating, comment):
-    conn = sqlite3.connect('library.db')
-    cursor = conn.cursor()
-    
-    try:
-        # Check if the user has already rated this book
+    def write(cursor):
+        # Ids are AUTOINCREMENT and never reused, so an id above the current
+        # maximum means the upsert inserted a new rating
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM ratings")
+        last_id = cursor.fetchone()[0]
+
+        # Add a new rating or replace the user's previous one
         cursor.execute('''
-        SELECT id FROM ratings WHERE user_id = ? AND book_id = ?
-        ''', (user_id, book_id))
-        existing_rating = cursor.fetchone()
-        
-        if existing_rating:
-            # Update existing rating
-            cursor.execute('''
-            UPDATE ratings SET rating = ?, comment = ?, date = CURRENT_TIMESTAMP
-            WHERE user_id = ? AND book_id = ?
-            ''', (rating, comment, user_id, book_id))
-        else:
-            # Add new rating
-            cursor.execute('''
-            INSERT INTO ratings (user_id, book_id, rating, comment)
-            VALUES (?, ?, ?, ?)
-            ''', (user_id, book_id, rating, comment))
-        
-        conn.commit()
+        INSERT INTO ratings (user_id, book_id, rating, comment)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, book_id) DO UPDATE
+        SET rating = excluded.rating, comment = excluded.comment, date = CURRENT_TIMESTAMP
+        RETURNING id
+        ''', (user_id, book_id, rating, comment))
+
+        return cursor.fetchone()[0] > last_id
+
+    try:
+        created = run_write(write)
         success = True
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
-        conn.rollback()
+        created = False
         success = False
-    
-    conn.close()
-    return success
 
-def get_book_ratings(book_id):
-    conn = sqlite3.connect('library.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT r.*, u.username, u.first_name, u.last_name
-    FROM ratings r
-    JOIN users u ON r.user_id = u.user_id
-    WHERE r.book_id = ?
-    ORDER BY r.date DESC
-    ''', (book_id,))
-    
-    ratings = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
-    return ratings
+    invalidate_book(book_id)
+    return success, created
+
+def _book_changed(book_id):
+    """Drop everything cached from a book that was added, edited or deleted."""
+    invalidate_book(book_id)
+    _inline_results.clear()
+    get_category_keyboard.cache_clear()
+    # Files the book no longer uses go once no other book uses them either
+    collect_unreferenced_files()
 
 def add_book(title, author, description, category, image_path, pdf_path, added_by):
-    conn = sqlite3.connect('library.db')
-    cursor = conn.cursor()
-    
-    try:
+    search_key = build_search_key(title, author, category)
+
+    def write(cursor):
         cursor.execute('''
-        INSERT INTO books (title, author, description, category, image_path, pdf_path, added_by)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (title, author, description, category, image_path, pdf_path, added_by))
-        
-        book_id = cursor.lastrowid
-        conn.commit()
+        INSERT INTO books (title, author, description, category, image_path, pdf_path, added_by, search_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (title, author, description, category, image_path, pdf_path, added_by, search_key))
+
+        return cursor.lastrowid
+
+    try:
+        book_id = run_write(write)
         success = True
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
-        conn.rollback()
         book_id = None
         success = False
-    
-    conn.close()
+
+    _book_changed(book_id)
     return success, book_id
 
 def update_book(book_id, title, author, description, category, image_path, pdf_path):
-    conn = sqlite3.connect('library.db')
-    cursor = conn.cursor()
-    
-    try:
+    search_key = build_search_key(title, author, category)
+
+    def write(cursor):
         # Get existing book data
         cursor.execute("SELECT image_path, pdf_path FROM books WHERE id = ?", (book_id,))
         book = cursor.fetchone()
-        
+
         if not book:
-            conn.close()
             return False
-        
+
         # Only update paths if new ones are provided
-        if not image_path:
-            image_path = book[0]
-        if not pdf_path:
-            pdf_path = book[1]
-        
         cursor.execute('''
-        UPDATE books 
-        SET title = ?, author = ?, description = ?, category = ?, image_path = ?, pdf_path = ?
+        UPDATE books
+        SET title = ?, author = ?, description = ?, category = ?, image_path = ?, pdf_path = ?, search_key = ?
         WHERE id = ?
-        ''', (title, author, description, category, image_path, pdf_path, book_id))
-        
-        conn.commit()
-        success = True
+        ''', (title, author, description, category, image_path or book[0], pdf_path or book[1], search_key, book_id))
+
+        return True
+
+    try:
+        success = run_write(write)
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
-        conn.rollback()
         success = False
-    
-    conn.close()
+
+    _book_changed(book_id)
     return success
 
-def delete_book(book_id):
-    conn = sqlite3.connect('library.db')
-    cursor = conn.cursor()
-    
-    try:
-        # Get the book to delete its files
-        cursor.execute("SELECT image_path, pdf_path FROM books WHERE id = ?", (book_id,))
-        book = cursor.fetchone()
-        
-        if not book:
-            conn.close()
+# Columns update_book_field may change, and those the search key is built from
+BOOK_EDITABLE_FIELDS = ('title', 'author', 'description', 'category', 'category_id', 'image_path', 'pdf_path')
+BOOK_SEARCH_KEY_FIELDS = ('title', 'author', 'category', 'category_id')
+
+def update_book_field(book_id, field, value):
+    if field not in BOOK_EDITABLE_FIELDS:
+        raise ValueError(f"Unknown book field: {field}")
+
+    def write(cursor):
+        cursor.execute(f"UPDATE books SET {field} = ? WHERE id = ?", (value, book_id))
+        if not cursor.rowcount:
             return False
-        
+
+        if field in BOOK_SEARCH_KEY_FIELDS:
+            cursor.execute("SELECT title, author, category FROM books WHERE id = ?", (book_id,))
+            title, author, category = cursor.fetchone()
+            cursor.execute("UPDATE books SET search_key = ? WHERE id = ?", (build_search_key(title, author, category), book_id))
+
+        return True
+
+    try:
+        success = run_write(write)
+    except sqlite3.Error as e:
+        logger.error(f"Database error: {e}")
+        success = False
+
+    _book_changed(book_id)
+    return success
+
+def delete_book(book_id):
+    def write(cursor):
         # Delete related records first
         cursor.execute("DELETE FROM ratings WHERE book_id = ?", (book_id,))
         cursor.execute("DELETE FROM favorites WHERE book_id = ?", (book_id,))
-        
+
         # Delete the book
         cursor.execute("DELETE FROM books WHERE id = ?", (book_id,))
-        
-        conn.commit()
-        
-        # Delete files if they exist
-        for path in book:
-            if path and os.path.exists(path):
-                try:
+
+        return cursor.rowcount > 0
+
+    try:
+        deleted = run_write(write)
+    except sqlite3.Error as e:
+        logger.error(f"Database error: {e}")
+        return False
+
+    if not deleted:
+        return False
+
+    _book_changed(book_id)
+    return True
+
+def add_user(user_id, username, first_name, last_name):
+    def write(cursor):
+        cursor.execute('''
+        INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
+        VALUES (?, ?, ?, ?)
+        ''', (user_id, username, first_name, last_name))
+
+    try:
+        run_write(write)
+        success = True
+    except sqlite3.Error as e:
+        logger.error(f"Database error: {e}")
+        success = False
+
+    return success
+
+def set_user_role(user_id, role):
+    def write(cursor):
+        cursor.execute('''
+        UPDATE users SET role = ? WHERE user_id = ?
+        ''', (role, user_id))
+
+    try:
+        run_write(write)
+        success = True
+    except sqlite3.Error as e:
+        logger.error(f"Database error: {e}")
+        success = False
+
+    _user_roles.pop(user_id)
+
+    return success
+
+def user_exists(user_id):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
+        result = cursor.fetchone()
+
+    return result is not None
+
+def count_users(role=None):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        if role:
+            cursor.execute("SELECT COUNT(*) FROM users WHERE role = ?", (role,))
+        else:
+            cursor.execute("SELECT COUNT(*) FROM users")
+        count = cursor.fetchone()[0]
+
+    return count
+
+def get_users_page(role=None, older_than=None, newer_than=None, limit=10):
+    """Return one page of users, newest first, plus whether newer and older ones exist.
+
+    Keyset-paginated on (registration_date, user_id) like get_favorites_page.
+    """
+    role_filter = "role = ? AND " if role else ""
+    role_params = (role,) if role else ()
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        if newer_than:
+            cursor.execute(f'''
+            SELECT * FROM users
+            WHERE {role_filter}(registration_date, user_id) > (?, ?)
+            ORDER BY registration_date, user_id
+            LIMIT ?
+            ''', (*role_params, *newer_than, limit))
+            users = [dict(row) for row in reversed(cursor.fetchall())]
+        elif older_than:
+            cursor.execute(f'''
+            SELECT * FROM users
+            WHERE {role_filter}(registration_date, user_id) < (?, ?)
+            ORDER BY registration_date DESC, user_id DESC
+            LIMIT ?
+            ''', (*role_params, *older_than, limit))
+            users = [dict(row) for row in cursor.fetchall()]
+        else:
+            cursor.execute(f'''
+            SELECT * FROM users
+            {'WHERE role = ?' if role else ''}
+            ORDER BY registration_date DESC, user_id DESC
+            LIMIT ?
+            ''', (*role_params, limit))
+            users = [dict(row) for row in cursor.fetchall()]
+
+        if not users:
+            return users, False, False
+
+        cursor.execute(f'''
+        SELECT EXISTS (SELECT 1 FROM users WHERE {role_filter}(registration_date, user_id) > (?, ?)),
+               EXISTS (SELECT 1 FROM users WHERE {role_filter}(registration_date, user_id) < (?, ?))
+        ''', (*role_params, users[0]['registration_date'], users[0]['user_id'],
+              *role_params, users[-1]['registration_date'], users[-1]['user_id']))
+        has_newer, has_older = cursor.fetchone()
+
+    return users, bool(has_newer), bool(has_older)
+
+def iter_users(batch_size=500):
+    """Yield every user as a tuple, oldest first, reading the table in batches."""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute('''
+        SELECT user_id, username, first_name, last_name, role, registration_date
+        FROM users ORDER BY registration_date, user_id
+        ''')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield tuple(row)
+
+def get_admins():
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT user_id, username, first_name, last_name FROM users WHERE role = 'admin'")
+        admins = cursor.fetchall()
+
+    return admins
+
+def get_all_categories():
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT id, name, book_count FROM categories ORDER BY name")
+        categories = [dict(row) for row in cursor.fetchall()]
+
+    return categories
+
+def get_category_id(name):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT id FROM categories WHERE name = ?", (name,))
+        result = cursor.fetchone()
+
+    return result[0] if result else None
+
+# Telegram file_id cache
+# Telegram returns a file_id for every file we upload; sending that id again
+# costs no upload. Ids are stored per book and kind ('image' or 'pdf') along
+# with the hash of the file they were uploaded from, so a replaced file is
+# uploaded afresh. The file's path and mtime are kept too, which lets inline
+# results check an id with a stat instead of reading the file.
+@functools.lru_cache(maxsize=4096)
+def _file_sha256(path, size, mtime_ns):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_sha256(path):
+    # Stored uploads are named by their hash
+    name = os.path.splitext(os.path.basename(path))[0]
+    if re.fullmatch(r'[0-9a-f]{64}', name):
+        return name
+
+    stat = os.stat(path)
+    return _file_sha256(path, stat.st_size, stat.st_mtime_ns)
+
+# Streamed downloads
+# Files sent to the bot are copied from Telegram in chunks into a temporary
+# file beside the destination, fsynced and renamed into place, so memory per
+# download is bounded by the chunk size and a half-written file is never
+# visible under the final name.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def download_telegram_file(file_id, dest_path):
+    """Download a Telegram file to dest_path and return its sha256 hex digest."""
+    file_info = bot.get_file(file_id)
+    if telebot.apihelper.FILE_URL:
+        url = telebot.apihelper.FILE_URL.format(BOT_TOKEN, file_info.file_path)
+    else:
+        url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
+
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file, _file_session.get(
+                url, stream=True, timeout=(API_CONNECT_TIMEOUT, FILE_READ_TIMEOUT),
+                proxies=telebot.apihelper.proxy) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                temp_file.write(chunk)
+                digest.update(chunk)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, dest_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+    return digest.hexdigest()
+
+# Upload storage
+# Uploaded files are stored once per content, as
+# uploads/<images|books>/<ab>/<cd>/<sha256>.<ext>, and books point at them.
+# stored_files counts the books referencing each path (triggers in migration
+# 14). Files nobody references are removed by collect_unreferenced_files, but
+# only once STORAGE_GRACE_SECONDS have passed since they were last stored, so
+# an upload whose book is not saved yet is never collected.
+STORAGE_GRACE_SECONDS = int(os.environ.get('STORAGE_GRACE_SECONDS', 24 * 60 * 60))
+STORAGE_EXTENSIONS = {'images': '.jpg', 'books': '.pdf'}
+
+def storage_path(kind, digest):
+    return os.path.join(UPLOAD_FOLDER, kind, digest[:2], digest[2:4], f"{digest}{STORAGE_EXTENSIONS[kind]}")
+
+def store_telegram_file(file_id, kind):
+    """Download a Telegram file into storage ('images' or 'books') and return its path, or None."""
+    fd, incoming_path = tempfile.mkstemp(dir=os.path.join(UPLOAD_FOLDER, kind), suffix=STORAGE_EXTENSIONS[kind])
+    os.close(fd)
+    try:
+        path = storage_path(kind, download_telegram_file(file_id, incoming_path))
+    except Exception as e:
+        logger.error(f"Error downloading file {file_id}: {e}")
+        with contextlib.suppress(OSError):
+            os.remove(incoming_path)
+        return None
+
+    # Placing the file runs on the writer thread, so it cannot interleave
+    # with collect_unreferenced_files removing the same path
+    def write(cursor):
+        if os.path.exists(path):
+            os.remove(incoming_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(incoming_path, path)
+
+        cursor.execute('''
+        INSERT INTO stored_files (path) VALUES (?)
+        ON CONFLICT (path) DO UPDATE SET stored_at = CURRENT_TIMESTAMP
+        ''', (path,))
+
+    try:
+        run_write(write)
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Error storing file {path}: {e}")
+        with contextlib.suppress(OSError):
+            os.remove(incoming_path)
+        return None
+
+    return path
+
+def collect_unreferenced_files():
+    def write(cursor):
+        cursor.execute('''
+        SELECT path FROM stored_files
+        WHERE ref_count <= 0 AND stored_at < datetime('now', ?)
+        ''', (f"-{STORAGE_GRACE_SECONDS} seconds",))
+        paths = [row[0] for row in cursor.fetchall()]
+
+        removed = []
+        for path in paths:
+            try:
+                if os.path.exists(path):
                     os.remove(path)
-                except Exception as e:
-                    logger.error(f"Error deleting file {path}: {e}")
-        
+            except OSError as e:
+                logger.error(f"Error deleting file {path}: {e}")
+                continue
+            cursor.execute("DELETE FROM stored_files WHERE path = ?", (path,))
+            removed.append(path)
+
+        return removed
+
+    try:
+        removed = run_write(write)
+    except sqlite3.Error as e:
+        logger.error(f"Database error: {e}")
+        removed = []
+
+    return removed
+
+def get_cached_file_id(book_id, kind, file_hash):
+    """Return the telegram_files row uploaded from this content, or None."""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute('''
+        SELECT file_hash, file_id, file_path, file_mtime_ns FROM telegram_files WHERE book_id = ? AND kind = ? AND file_hash = ?
+        ''', (book_id, kind, file_hash))
+        result = cursor.fetchone()
+
+    return dict(result) if result else None
+
+def get_cached_file_ids(book_ids):
+    """Map (book_id, kind) to the telegram_files row for the given books."""
+    if not book_ids:
+        return {}
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(f'''
+        SELECT book_id, kind, file_hash, file_id, file_path, file_mtime_ns FROM telegram_files
+        WHERE book_id IN ({','.join('?' * len(book_ids))})
+        ''', list(book_ids))
+        file_ids = {(row['book_id'], row['kind']): dict(row) for row in cursor.fetchall()}
+
+    return file_ids
+
+def cached_file_matches(cached, path):
+    """Whether a get_cached_file_ids() row was uploaded from the file now at path.
+
+    Only stats the file: rows from before paths were recorded match stored
+    uploads by their hash-derived name, and legacy names not at all until
+    the file is sent again.
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return False
+
+    if cached['file_path'] == path and cached['file_mtime_ns'] == mtime_ns:
+        return True
+    name = os.path.splitext(os.path.basename(path))[0]
+    return bool(re.fullmatch(r'[0-9a-f]{64}', name)) and name == cached['file_hash']
+
+def save_file_id(book_id, kind, file_hash, file_id, file_path):
+    try:
+        mtime_ns = os.stat(file_path).st_mtime_ns
+    except OSError:
+        mtime_ns = None
+
+    def write(cursor):
+        cursor.execute('''
+        INSERT INTO telegram_files (book_id, kind, file_hash, file_id, file_path, file_mtime_ns) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (book_id, kind) DO UPDATE
+        SET file_hash = excluded.file_hash, file_id = excluded.file_id, file_path = excluded.file_path,
+            file_mtime_ns = excluded.file_mtime_ns, updated_at = CURRENT_TIMESTAMP
+        ''', (book_id, kind, file_hash, file_id, file_path, mtime_ns))
+
+    try:
+        run_write(write)
         success = True
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
-        conn.rollback()
         success = False
-    
-    conn.close()
+
     return success
 
-def add_user(user_id, username, first_name, last_name):
-    conn = sqlite3.connect('library.db')
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute('''
-        INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
-        VALUES (?, ?, ?, ?)
-        ''', (user_id, username, first_name, last_name))
-        
-        conn.commit()
-        success = True
-    except sqlite3.Error as e:
-        logger.error(f"Database error: {e}")
-        conn.rollback()
-        success = False
-    
-    conn.close()
-    return success
+# Statistics
+# Totals and per-day counts are kept current by triggers (migration 12).
+# The top books and per-category counts need aggregate queries, so they are
+# computed by refresh_stats_snapshot every STATS_REFRESH_INTERVAL seconds in
+# the background and read back from stats_snapshot.
+STATS_REFRESH_INTERVAL = int(os.environ.get('STATS_REFRESH_INTERVAL', 300))
+STATS_TREND_DAYS = 7
+
+_stats_refresher = None
+_stats_refresher_lock = threading.Lock()
+
+def refresh_stats_snapshot():
+    # The aggregates are read on a pooled connection, which WAL lets run
+    # alongside writes; only storing the snapshot goes through the writer
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            # Get top 5 books by rating
+            cursor.execute('''
+            SELECT b.id, b.title, 1.0 * s.rating_sum / s.rating_count as avg_rating, s.rating_count as num_ratings
+            FROM book_rating_stats s
+            JOIN books b ON b.id = s.book_id
+            WHERE s.rating_count > 0
+            ORDER BY avg_rating DESC, num_ratings DESC
+            LIMIT 5
+            ''')
+            top_books = [tuple(row) for row in cursor.fetchall()]
+
+            # Fill up with unrated books, as before
+            if len(top_books) < 5:
+                cursor.execute('''
+                SELECT id, title, NULL, 0 FROM books
+                WHERE id NOT IN (SELECT book_id FROM book_rating_stats WHERE rating_count > 0)
+                LIMIT ?
+                ''', (5 - len(top_books),))
+                top_books += [tuple(row) for row in cursor.fetchall()]
+
+            # Get books by category from the trigger-kept counts; books without
+            # one are the rest of the total
+            cursor.execute('''
+            SELECT name, book_count FROM categories WHERE book_count > 0
+            UNION ALL
+            SELECT NULL, COALESCE((SELECT value FROM stats_counters WHERE name = 'books'), 0)
+                         - (SELECT COALESCE(SUM(book_count), 0) FROM categories)
+            ORDER BY 2 DESC
+            ''')
+            books_by_category = [tuple(row) for row in cursor.fetchall() if row[1] > 0]
+
+        def write(cursor):
+            cursor.executemany('''
+            INSERT OR REPLACE INTO stats_snapshot (name, value, refreshed_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ''', [('top_books', json.dumps(top_books)), ('books_by_category', json.dumps(books_by_category))])
+
+        run_write(write)
+        success = True
+    except sqlite3.Error as e:
+        logger.error(f"Database error: {e}")
+        success = False
+
+    return success
+
+def _stats_refresh_loop():
+    while True:
+        time.sleep(STATS_REFRESH_INTERVAL)
+        refresh_stats_snapshot()
+
+def start_stats_refresher():
+    global _stats_refresher
+
+    with _stats_refresher_lock:
+        if _stats_refresher is not None:
+            return
+        refresh_stats_snapshot()
+        _stats_refresher = threading.Thread(target=_stats_refresh_loop, name='stats-refresher', daemon=True)
+        _stats_refresher.start()
+
+def get_statistics():
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT name, value FROM stats_counters")
+        counters = dict(cursor.fetchall())
+
+        cursor.execute("SELECT name, value, refreshed_at FROM stats_snapshot")
+        snapshot = {name: (json.loads(value), refreshed_at) for name, value, refreshed_at in cursor.fetchall()}
+
+        # New users, books and ratings over the last days, newest first
+        cursor.execute('''
+        SELECT day, new_users, new_books, new_ratings FROM stats_daily
+        WHERE day > date('now', ?)
+        ORDER BY day DESC
+        ''', (f"-{STATS_TREND_DAYS} days",))
+        daily = [tuple(row) for row in cursor.fetchall()]
+
+    top_books, refreshed_at = snapshot.get('top_books', ([], None))
+    books_by_category, _ = snapshot.get('books_by_category', ([], None))
+
+    return {
+        'total_books': counters.get('books', 0),
+        'total_users': counters.get('users', 0),
+        'total_ratings': counters.get('ratings', 0),
+        'top_books': top_books,
+        'books_by_category': books_by_category,
+        'daily': daily,
+        'refreshed_at': refreshed_at
+    }
+
+# Background workers
+# CPU-heavy work on uploads runs on spawn process pools, and its results are
+# written back through the writer thread.
+class WorkerPool:
+    """Process pool started on first use and replaced when a dead worker breaks it."""
+
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """Return a Future for func(*args), or None if the pool could not be restarted."""
+        with self._lock:
+            for attempt in range(2):
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.max_workers,
+                        mp_context=multiprocessing.get_context('spawn')
+                    )
+                try:
+                    return self._executor.submit(func, *args)
+                except BrokenProcessPool:
+                    # A worker died and took the pool with it; start a new one
+                    logger.warning(f"{self.name} pool is broken; restarting it")
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+        return None
+
+def submit_book_write(book_id, func):
+    """Queue func(cursor) for the writer thread and drop the cached book once it is applied."""
+    def done(write_future):
+        if write_future.exception():
+            logger.error(f"Database error: {write_future.exception()}")
+        invalidate_book(book_id)
+
+    submit_write(func).add_done_callback(done)
+
+# PDF text indexing
+# Text is extracted from uploaded PDFs on a process pool, off the handler
+# threads, and stored in book_text_chunks for search. Books whose text is not
+# indexed yet have text_status NULL, so an interrupted backlog is picked up
+# again by resume_pdf_indexing() at startup.
+PDF_TEXT_WORKERS = int(os.environ.get('PDF_TEXT_WORKERS', 2))
+PDF_TEXT_CHUNK_SIZE = 2000
+
+_pdf_pool = WorkerPool('PDF text', PDF_TEXT_WORKERS)
+
+def extract_pdf_text(pdf_path):
+    """Return (page_count, [(page_number, text), ...]); runs in a worker process."""
+    reader = PdfReader(pdf_path)
+    return len(reader.pages), [(number, page.extract_text() or '') for number, page in enumerate(reader.pages, 1)]
+
+def _chunk_text(text):
+    chunk = ''
+    for word in text.split():
+        if chunk and len(chunk) + len(word) + 1 > PDF_TEXT_CHUNK_SIZE:
+            yield chunk
+            chunk = ''
+        chunk = f"{chunk} {word}" if chunk else word
+    if chunk:
+        yield chunk
+
+def _store_pdf_text(book_id, pdf_path, future):
+    try:
+        page_count, pages = future.result()
+        chunks = [(book_id, number, chunk) for number, text in pages for chunk in _chunk_text(text)]
+        status = 'done'
+    except BrokenProcessPool as e:
+        # The pool died under this job, not the PDF; leave the book pending
+        # so resume_pdf_indexing() tries it again at startup
+        logger.error(f"Error extracting text from {pdf_path}: {e}")
+        page_count, chunks, status = None, [], None
+    except Exception as e:
+        logger.error(f"Error extracting text from {pdf_path}: {e}")
+        page_count, chunks, status = None, [], 'failed'
+
+    def write(cursor):
+        # The PDF may have been replaced while it was being read
+        cursor.execute("SELECT pdf_path FROM books WHERE id = ?", (book_id,))
+        book = cursor.fetchone()
+        if not book or book[0] != pdf_path:
+            return
+
+        cursor.execute("DELETE FROM book_text_chunks WHERE book_id = ?", (book_id,))
+        cursor.executemany("INSERT INTO book_text_chunks (book_id, page, content) VALUES (?, ?, ?)", chunks)
+        cursor.execute("UPDATE books SET page_count = ?, text_status = ? WHERE id = ?", (page_count, status, book_id))
+
+    submit_book_write(book_id, write)
+
+def schedule_pdf_indexing(book_id, pdf_path):
+    if PdfReader is None or not pdf_path:
+        return
+
+    future = _pdf_pool.submit(extract_pdf_text, pdf_path)
+    if future is None:
+        # text_status stays NULL, so the book is retried at startup
+        logger.error(f"Could not schedule text extraction for book {book_id}")
+        return
+
+    future.add_done_callback(functools.partial(_store_pdf_text, book_id, pdf_path))
+
+def resume_pdf_indexing():
+    if PdfReader is None:
+        logger.warning("pypdf is not installed; PDF text will not be searchable")
+        return
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT id, pdf_path FROM books WHERE text_status IS NULL AND pdf_path IS NOT NULL")
+        pending = cursor.fetchall()
+
+    for book_id, pdf_path in pending:
+        if os.path.exists(pdf_path):
+            schedule_pdf_indexing(book_id, pdf_path)
+
+# Cover thumbnails and previews
+# Each book gets two JPEGs derived from its cover, or from the first page of
+# its PDF when it has no cover: a small thumbnail for inline results and a
+# preview sized for the details view. They are rendered on a process pool and
+# named after the source's hash, so books with the same source share them and
+# a changed source gets new ones. The files are tracked in stored_files like
+# uploads and collected once no book uses them.
+PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS', 1))
+PREVIEW_SIZES = {'thumbnail': 320, 'preview': 1280}
+PREVIEW_QUALITY = 85
+PREVIEW_PDF_DPI = 150
+
+_preview_pool = WorkerPool('Preview', PREVIEW_WORKERS)
+
+def preview_paths(digest):
+    directory = os.path.join(UPLOAD_FOLDER, 'previews', digest[:2], digest[2:4])
+    return {name: os.path.join(directory, f"{digest}_{name}.jpg") for name in PREVIEW_SIZES}
+
+def _preview_source(image_path, pdf_path):
+    """Return the (path, is_pdf) previews are made from, or (None, False)."""
+    if image_path and os.path.exists(image_path):
+        return image_path, False
+    if pdf_path and os.path.exists(pdf_path) and pymupdf is not None:
+        return pdf_path, True
+    return None, False
+
+def render_previews(source_path, is_pdf, outputs):
+    # Runs in a worker process
+    if is_pdf:
+        with pymupdf.open(source_path) as document:
+            if not document.page_count:
+                return
+            pixmap = document[0].get_pixmap(dpi=PREVIEW_PDF_DPI, alpha=False)
+            image = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+    else:
+        with Image.open(source_path) as original:
+            image = ImageOps.exif_transpose(original).convert('RGB')
+
+    for name, path in outputs.items():
+        if os.path.exists(path):
+            continue
+        resized = image.copy()
+        resized.thumbnail((PREVIEW_SIZES[name], PREVIEW_SIZES[name]))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        os.close(fd)
+        resized.save(temp_path, 'JPEG', quality=PREVIEW_QUALITY, optimize=True, progressive=True)
+        os.replace(temp_path, path)
+
+def _store_previews(book_id, source_path, outputs, future=None):
+    if future is not None:
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Error rendering previews from {source_path}: {e}")
+            return
+
+    def write(cursor):
+        # The cover or PDF may have been replaced while rendering
+        cursor.execute("SELECT image_path, pdf_path FROM books WHERE id = ?", (book_id,))
+        book = cursor.fetchone()
+        if not book or _preview_source(*book)[0] != source_path:
+            return
+        if not all(os.path.exists(path) for path in outputs.values()):
+            return
+
+        cursor.executemany('''
+        INSERT INTO stored_files (path) VALUES (?)
+        ON CONFLICT (path) DO UPDATE SET stored_at = CURRENT_TIMESTAMP
+        ''', [(path,) for path in outputs.values()])
+        cursor.execute('''
+        UPDATE books SET thumbnail_path = ?, preview_path = ? WHERE id = ?
+        ''', (outputs['thumbnail'], outputs['preview'], book_id))
+
+    submit_book_write(book_id, write)
+
+def schedule_previews(book_id, image_path, pdf_path):
+    if Image is None:
+        return
+
+    source_path, is_pdf = _preview_source(image_path, pdf_path)
+    if not source_path:
+        return
+
+    outputs = preview_paths(file_sha256(source_path))
+    if all(os.path.exists(path) for path in outputs.values()):
+        _store_previews(book_id, source_path, outputs)
+        return
+
+    future = _preview_pool.submit(render_previews, source_path, is_pdf, outputs)
+    if future is None:
+        # preview_path stays NULL, so the book is retried at startup
+        logger.error(f"Could not schedule previews for book {book_id}")
+        return
+
+    future.add_done_callback(functools.partial(_store_previews, book_id, source_path, outputs))
+
+def resume_previews():
+    if Image is None:
+        logger.warning("Pillow is not installed; covers will be sent as uploaded")
+        return
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
 
-def set_user_role(user_id, role):
-    conn = sqlite3.connect('library.db')
-    cursor = conn.cursor()
-    
-    try:
         cursor.execute('''
-        UPDATE users SET role = ? WHERE user_id = ?
-        ''', (role, user_id))
-        
-        conn.commit()
-        success = True
-    except sqlite3.Error as e:
-        logger.error(f"Database error: {e}")
-        conn.rollback()
-        success = False
-    
-    conn.close()
-    return success
+        SELECT id, image_path, pdf_path FROM books
+        WHERE preview_path IS NULL AND (image_path IS NOT NULL OR pdf_path IS NOT NULL)
+        ''')
+        pending = cursor.fetchall()
+
+    for book_id, image_path, pdf_path in pending:
+        schedule_previews(book_id, image_path, pdf_path)
+
+# In-process caches
+class LRUCache:
+    """Thread-safe mapping that keeps at most maxsize most recently used keys.
+
+    With ttl (seconds) set, entries also expire that long after being stored.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            expires, value = self._data[key]
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, (None, default))[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+# Role cache
+# Permission checks read roles from memory. set_user_role drops the changed
+# user's entry; changes made by other processes (or by hand) bump the 'roles'
+# row in cache_versions through a trigger, which is polled at most every
+# ROLE_CACHE_CHECK_INTERVAL seconds and clears the whole cache when it moves.
+ROLE_CACHE_SIZE = int(os.environ.get('ROLE_CACHE_SIZE', 10000))
+ROLE_CACHE_CHECK_INTERVAL = float(os.environ.get('ROLE_CACHE_CHECK_INTERVAL', 5))
+
+_user_roles = LRUCache(ROLE_CACHE_SIZE)
+_role_cache_lock = threading.Lock()
+_role_cache_version = None
+_role_cache_checked = 0.0
+
+def _check_role_cache_version():
+    global _role_cache_version, _role_cache_checked
+
+    with _role_cache_lock:
+        now = time.monotonic()
+        if now - _role_cache_checked < ROLE_CACHE_CHECK_INTERVAL:
+            return
+        _role_cache_checked = now
 
-def get_all_users():
-    conn = sqlite3.connect('library.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT * FROM users ORDER BY registration_date DESC")
-    
-    users = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    
-    return users
+        with db_connection() as conn:
+            cursor = conn.cursor()
 
-def get_statistics():
-    conn = sqlite3.connect('library.db')
-    cursor = conn.cursor()
-    
-    # Get total number of books
-    cursor.execute("SELECT COUNT(*) FROM books")
-    total_books = cursor.fetchone()[0]
-    
-    # Get total number of users
-    cursor.execute("SELECT COUNT(*) FROM users")
-    total_users = cursor.fetchone()[0]
-    
-    # Get total number of ratings
-    cursor.execute("SELECT COUNT(*) FROM ratings")
-    total_ratings = cursor.fetchone()[0]
-    
-    # Get top 5 books by rating
-    cursor.execute('''
-    SELECT b.id, b.title, AVG(r.rating) as avg_rating, COUNT(r.id) as num_ratings
-    FROM books b
-    LEFT JOIN ratings r ON b.id = r.book_id
-    GROUP BY b.id
-    ORDER BY avg_rating DESC, num_ratings DESC
-    LIMIT 5
-    ''')
-    top_books = cursor.fetchall()
-    
-    # Get books by category
-    cursor.execute('''
-    SELECT category, COUNT(*) as count
-    FROM books
-    GROUP BY category
-    ORDER BY count DESC
-    ''')
-    books_by_category = cursor.fetchall()
-    
-    conn.close()
-    
-    return {
-        'total_books': total_books,
-        'total_users': total_users,
-        'total_ratings': total_ratings,
-        'top_books': top_books,
-        'books_by_category': books_by_category
-    }
+            cursor.execute("SELECT version FROM cache_versions WHERE name = 'roles'")
+            result = cursor.fetchone()
+
+        version = result[0] if result else None
+        if version != _role_cache_version:
+            _user_roles.clear()
+            _role_cache_version = version
+
+def get_user_role(user_id):
+    _check_role_cache_version()
+
+    role = _user_roles.get(user_id)
+    if role is not None:
+        return role
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT role FROM users WHERE user_id = ?", (user_id,))
+        result = cursor.fetchone()
+
+    role = result[0] if result else 'user'
+    _user_roles.set(user_id, role)
+    return role
+
+# Book cache
+# Book rows, together with their rendered detail caption, are kept in memory
+# in front of _load_book. Every write that changes what a book row or its
+# caption shows calls invalidate_book. A load that raced with an invalidation
+# is returned but not stored, so a stale row never outlives the write.
+BOOK_CACHE_SIZE = int(os.environ.get('BOOK_CACHE_SIZE', 1024))
+
+_books = LRUCache(BOOK_CACHE_SIZE)
+_book_cache_lock = threading.Lock()
+_book_cache_generation = 0
+_book_cache_metrics = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+def render_book_caption(book):
+    # Rating aggregates are maintained alongside the ratings table
+    avg_rating = book['rating_sum'] / book['rating_count'] if book['rating_count'] else 0
+
+    text = f"📚 *{book['title']}*\n\n" \
+           f"👤 *Muallif:* {book['author']}\n" \
+           f"🔖 *Kategoriya:* {book['category']}\n" \
+           f"⭐ *Reyting:* {avg_rating:.1f} ({book['rating_count']} baholash)\n"
+    if book.get('page_count'):
+        text += f"📄 *Sahifalar:* {book['page_count']}\n"
+    text += f"\n📝 *Tavsif:*\n{book['description']}\n\n"
+    return text
+
+def _get_cached_book(book_id):
+    entry = _books.get(book_id)
+    with _book_cache_lock:
+        _book_cache_metrics['hits' if entry else 'misses'] += 1
+        generation = _book_cache_generation
+    if entry:
+        return entry
+
+    book = _load_book(book_id)
+    if not book:
+        return None
+
+    entry = (book, render_book_caption(book))
+    with _book_cache_lock:
+        if generation == _book_cache_generation:
+            _books.set(book_id, entry)
+    return entry
+
+def get_book_by_id(book_id):
+    entry = _get_cached_book(book_id)
+    return dict(entry[0]) if entry else None
+
+def get_book_with_caption(book_id):
+    """Return (book, caption) for the details view, or (None, None)."""
+    entry = _get_cached_book(book_id)
+    return (dict(entry[0]), entry[1]) if entry else (None, None)
+
+def invalidate_book(book_id):
+    global _book_cache_generation
+
+    with _book_cache_lock:
+        _book_cache_generation += 1
+        _book_cache_metrics['invalidations'] += 1
+        _books.pop(book_id)
+
+def get_book_cache_metrics():
+    with _book_cache_lock:
+        metrics = dict(_book_cache_metrics)
+    metrics['size'] = len(_books)
+    return metrics
+
+# Helper function to escape user text for legacy Markdown messages
+# (only valid outside of *bold* and other entities)
+def escape_markdown(text):
+    return re.sub(r'([_*`\[])', r'\\\1', str(text))
+
+# Result lists
+# Search and category results are shown as one message with numbered entries
+# and ◀ / ▶ buttons that edit it in place. The query behind a list is kept
+# server-side under a short token, since callback_data is limited to 64 bytes.
+RESULTS_PAGE_SIZE = 10
+
+_result_lists = LRUCache(4096)
+
+def save_result_list(kind, key):
+    token = hashlib.sha1(f"{kind}:{key}".encode('utf-8')).hexdigest()[:12]
+    _result_lists.set(token, (kind, key))
+    return token
+
+def render_results_page(token, page):
+    """Return (text, markup) for a page of a saved list, or None if it expired or is empty."""
+    listing = _result_lists.get(token)
+    if listing is None:
+        return None
+
+    kind, key = listing
+    offset = page * RESULTS_PAGE_SIZE
+    fetch = search_books if kind == 'search' else get_books_by_category
+    books = fetch(key, limit=RESULTS_PAGE_SIZE + 1, offset=offset)
+    has_next = len(books) > RESULTS_PAGE_SIZE
+    books = books[:RESULTS_PAGE_SIZE]
+
+    if not books:
+        return None
+
+    if kind == 'search':
+        text = f"🔍 *Qidiruv natijalari:* {escape_markdown(key)}"
+    else:
+        text = f"📚 *Kategoriya:* {escape_markdown(books[0]['category'])}"
+    text += f" ({page + 1}-sahifa)\n\n"
+
+    markup = types.InlineKeyboardMarkup(row_width=5)
+    buttons = []
+    for number, book in enumerate(books, offset + 1):
+        text += f"{number}. {escape_markdown(book['title'])} — {escape_markdown(book['author'])}\n"
+        if book.get('snippet'):
+            text += f"    ↳ {escape_markdown(book['snippet'])}\n"
+        buttons.append(types.InlineKeyboardButton(str(number), callback_data=f"book_{book['id']}"))
+    markup.add(*buttons)
+
+    navigation = []
+    if page > 0:
+        navigation.append(types.InlineKeyboardButton("◀", callback_data=f"results_{token}_{page - 1}"))
+    if has_next:
+        navigation.append(types.InlineKeyboardButton("▶", callback_data=f"results_{token}_{page + 1}"))
+    if navigation:
+        markup.row(*navigation)
+
+    return text, markup
+
+# Keyset pages
+# Lists ordered newest first by (timestamp, id) are paged by the row just
+# outside the page. In callback_data a page is "top", "o_<stamp>_<id>" (rows
+# older than that one) or "n_<stamp>_<id>" (rows newer than it), where stamp
+# is the timestamp as digits.
+def _keyset_key(timestamp, row_id):
+    return f"{re.sub(r'[^0-9]', '', timestamp)}_{row_id}"
+
+def _parse_keyset_page(page):
+    if page == 'top':
+        return {}
+    direction, stamp, row_id = page.split('_')
+    timestamp = f"{stamp[:4]}-{stamp[4:6]}-{stamp[6:8]} {stamp[8:10]}:{stamp[10:12]}:{stamp[12:14]}"
+    key = (timestamp, int(row_id))
+    return {'older_than': key} if direction == 'o' else {'newer_than': key}
+
+BOOK_FILE_COLUMNS = {'image': 'image_path', 'preview': 'preview_path', 'pdf': 'pdf_path'}
+
+# Helper function to send a book's cover ('image'), its preview ('preview') or PDF ('pdf')
+# send(media) performs the actual API call with either a cached file_id or an
+# open file; the upload path refreshes the cache from Telegram's response.
+
+def send_book_file(book, kind, send):
+    path = book[BOOK_FILE_COLUMNS[kind]]
+    file_hash = file_sha256(path)
+
+    cached = get_cached_file_id(book['id'], kind, file_hash)
+    if cached:
+        try:
+            result = send(cached['file_id'])
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code != 400 or 'file' not in e.description.lower():
+                raise
+            logger.warning(f"Cached file_id rejected for book {book['id']} ({kind}): {e.description}")
+        else:
+            # Ids cached before paths were recorded, or from a touched file,
+            # don't match in inline results until the file is recorded again
+            if not cached_file_matches(cached, path):
+                save_file_id(book['id'], kind, file_hash, cached['file_id'], path)
+            return result
+
+    with open(path, 'rb') as f:
+        result = send(f)
+
+    if isinstance(result, types.Message):
+        if result.photo:
+            save_file_id(book['id'], kind, file_hash, result.photo[-1].file_id, path)
+        elif result.document:
+            save_file_id(book['id'], kind, file_hash, result.document.file_id, path)
+
+    return result
 
 # Telegram bot handlers
 @bot.message_handler(commands=['start'])
@@ -501,71 +2489,194 @@ def search_command(message):
     bot.register_next_step_handler(message, process_search)
 
 def process_search(message):
-    query = message.text
-    books = search_books(query)
+    query = (message.text or '').strip()
+    page = render_results_page(save_result_list('search', query), 0) if query else None
     
-    if not books:
+    if not page:
         bot.send_message(message.chat.id, "Hech qanday kitob topilmadi. Iltimos, boshqa so'rovni kiriting.")
         return
     
-    for book in books[:10]:  # Limit to 10 results
-        # Create inline keyboard for each book
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("Batafsil", callback_data=f"book_{book['id']}"))
-        
-        # Send book info
-        caption = f"📚 *{book['title']}*\n👤 *Muallif:* {book['author']}\n🔖 *Kategoriya:* {book['category']}"
-        
-        if book['image_path'] and os.path.exists(book['image_path']):
-            with open(book['image_path'], 'rb') as photo:
-                bot.send_photo(message.chat.id, photo, caption=caption, reply_markup=markup, parse_mode='Markdown')
-        else:
-            bot.send_message(message.chat.id, caption, reply_markup=markup, parse_mode='Markdown')
+    text, markup = page
+    bot.send_message(message.chat.id, text, reply_markup=markup, parse_mode='Markdown')
 
-@bot.message_handler(func=lambda message: message.text == '📚 Kategoriyalar')
-def categories_command(message):
-    conn = sqlite3.connect('library.db')
-    cursor = conn.cursor()
+@bot.callback_query_handler(func=lambda call: call.data.startswith('results_'))
+def results_page_callback(call):
+    _, token, page = call.data.split('_')
+    rendered = render_results_page(token, int(page))
     
-    cursor.execute("SELECT DISTINCT category FROM books")
-    categories = cursor.fetchall()
-    
-    conn.close()
+    if not rendered:
+        bot.answer_callback_query(call.id, "Natijalar eskirgan. Iltimos, qaytadan qidiring.")
+        return
     
+    text, markup = rendered
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='Markdown')
+    bot.answer_callback_query(call.id)
+
+# Inline mode: "@bot query" from any chat
+# Result ids per query are cached briefly, since Telegram sends a query for
+# every keystroke. Books are offered as their PDF or cover using file_ids from
+# earlier uploads. Books never uploaded yet are offered by preview URL when
+# PUBLIC_URL (where this app's /uploads routes are reachable) is set, and as
+# text otherwise.
+PUBLIC_URL = os.environ.get('PUBLIC_URL')
+INLINE_PAGE_SIZE = 20
+INLINE_MAX_RESULTS = 200
+INLINE_CACHE_TTL = 300
+
+_inline_results = LRUCache(2048, ttl=INLINE_CACHE_TTL)
+
+def public_file_url(path):
+    if not PUBLIC_URL or not path or not os.path.exists(path):
+        return None
+    relative = os.path.relpath(path, UPLOAD_FOLDER).replace(os.sep, '/')
+    return f"{PUBLIC_URL.rstrip('/')}/uploads/{relative}"
+
+def build_inline_result(book, file_ids):
+    caption = f"📚 {book['title']} - {book['author']}"
+
+    # The details view caches the resized preview rather than the cover once
+    # one exists, so either of them can be reused as a photo
+    for kind in ('pdf', 'preview', 'image'):
+        path = book[f'{kind}_path']
+        cached = file_ids.get((book['id'], kind))
+        # Checked with a stat; hashing here would read whole files per keystroke
+        if not cached or not path or not cached_file_matches(cached, path):
+            continue
+        if kind == 'pdf':
+            return types.InlineQueryResultCachedDocument(
+                f"pdf_{book['id']}", cached['file_id'], book['title'], description=book['author'], caption=caption)
+        return types.InlineQueryResultCachedPhoto(
+            f"{kind}_{book['id']}", cached['file_id'], title=book['title'], description=book['author'], caption=caption)
+
+    thumbnail_url = public_file_url(book.get('thumbnail_path'))
+    preview_url = public_file_url(book.get('preview_path'))
+    if thumbnail_url and preview_url:
+        return types.InlineQueryResultPhoto(
+            f"preview_{book['id']}", preview_url, thumbnail_url,
+            title=book['title'], description=book['author'], caption=caption)
+
+    return types.InlineQueryResultArticle(
+        f"book_{book['id']}", book['title'],
+        types.InputTextMessageContent(f"{caption}\n🔖 {book['category']}"),
+        description=book['author'], thumbnail_url=thumbnail_url)
+
+@bot.inline_handler(func=lambda inline_query: True)
+def inline_search(inline_query):
+    query = inline_query.query.strip()
+    if not query:
+        bot.answer_inline_query(inline_query.id, [], cache_time=INLINE_CACHE_TTL)
+        return
+
+    cache_key = query.casefold()
+    book_ids = _inline_results.get(cache_key)
+    if book_ids is None:
+        book_ids = [book['id'] for book in search_books(query, limit=INLINE_MAX_RESULTS)]
+        _inline_results.set(cache_key, book_ids)
+
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    page_ids = book_ids[offset:offset + INLINE_PAGE_SIZE]
+    file_ids = get_cached_file_ids(page_ids)
+    results = [build_inline_result(book, file_ids) for book in get_books_by_ids(page_ids)]
+
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(book_ids) else ''
+    bot.answer_inline_query(inline_query.id, results, cache_time=INLINE_CACHE_TTL, next_offset=next_offset)
+
+# The category menu only changes with the books, so it is built once and
+# rebuilt after the next book write (see the cache_clear calls above)
+@functools.lru_cache(maxsize=1)
+def get_category_keyboard():
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT id, name, book_count FROM categories WHERE book_count > 0 ORDER BY name")
+        categories = cursor.fetchall()
+
     if not categories:
+        return None
+
+    markup = types.InlineKeyboardMarkup()
+    for category_id, name, book_count in categories:
+        markup.add(types.InlineKeyboardButton(f"{name} ({book_count})", callback_data=f"cat_{category_id}"))
+    return markup
+
+@bot.message_handler(func=lambda message: message.text == '📚 Kategoriyalar')
+def categories_command(message):
+    markup = get_category_keyboard()
+    
+    if not markup:
         bot.send_message(message.chat.id, "Hech qanday kategoriya topilmadi.")
         return
     
-    markup = types.InlineKeyboardMarkup()
-    for category in categories:
-        if category[0]:  # Skip None categories
-            markup.add(types.InlineKeyboardButton(category[0], callback_data=f"category_{category[0]}"))
-    
     bot.send_message(message.chat.id, "Kategoriyani tanlang:", reply_markup=markup)
 
+# Favorites are shown as one message, a page at a time (see keyset pages above)
+FAVORITES_PAGE_SIZE = 10
+
+def render_favorites_page(user_id, page='top'):
+    """Return (text, markup) for a favorites page, or None if the user has no favorites."""
+    count = count_user_favorites(user_id)
+    if not count:
+        return None
+
+    books, has_newer, has_older = get_favorites_page(user_id, limit=FAVORITES_PAGE_SIZE, **_parse_keyset_page(page))
+    if not books:
+        # The page emptied out (e.g. its last book was removed); start over
+        page = 'top'
+        books, has_newer, has_older = get_favorites_page(user_id, limit=FAVORITES_PAGE_SIZE)
+
+    text = f"⭐ *Sevimlilar:* {count} ta kitob\n\n"
+    markup = types.InlineKeyboardMarkup()
+    for number, book in enumerate(books, 1):
+        text += f"{number}. {escape_markdown(book['title'])} — {escape_markdown(book['author'])}\n"
+        markup.row(
+            types.InlineKeyboardButton(f"{number}. {book['title'][:40]}", callback_data=f"book_{book['id']}"),
+            types.InlineKeyboardButton("❌", callback_data=f"favrm_{book['id']}_{page}")
+        )
+
+    navigation = []
+    if has_newer:
+        navigation.append(types.InlineKeyboardButton("◀", callback_data=f"favpage_n_{_keyset_key(books[0]['date_added'], books[0]['favorite_id'])}"))
+    if has_older:
+        navigation.append(types.InlineKeyboardButton("▶", callback_data=f"favpage_o_{_keyset_key(books[-1]['date_added'], books[-1]['favorite_id'])}"))
+    if navigation:
+        markup.row(*navigation)
+
+    return text, markup
+
 @bot.message_handler(func=lambda message: message.text == '⭐ Sevimlilar')
 def favorites_command(message):
-    user_id = message.from_user.id
-    books = get_user_favorites(user_id)
+    page = render_favorites_page(message.from_user.id)
     
-    if not books:
+    if not page:
         bot.send_message(message.chat.id, "Sizda hali sevimli kitoblar yo'q.")
         return
     
-    for book in books:
-        # Create inline keyboard for each book
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("Batafsil", callback_data=f"book_{book['id']}"))
-        markup.add(types.InlineKeyboardButton("❌ Sevimlilardan olib tashlash", callback_data=f"remove_favorite_{book['id']}"))
-        
-        # Send book info
-        caption = f"📚 *{book['title']}*\n👤 *Muallif:* {book['author']}\n🔖 *Kategoriya:* {book['category']}"
-        
-        if book['image_path'] and os.path.exists(book['image_path']):
-            with open(book['image_path'], 'rb') as photo:
-                bot.send_photo(message.chat.id, photo, caption=caption, reply_markup=markup, parse_mode='Markdown')
-        else:
-            bot.send_message(message.chat.id, caption, reply_markup=markup, parse_mode='Markdown')
+    text, markup = page
+    bot.send_message(message.chat.id, text, reply_markup=markup, parse_mode='Markdown')
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('favpage_'))
+def favorites_page_callback(call):
+    page = render_favorites_page(call.from_user.id, call.data.split('_', 1)[1])
+    
+    if not page:
+        bot.edit_message_text("Sizda hali sevimli kitoblar yo'q.", call.message.chat.id, call.message.message_id)
+    else:
+        text, markup = page
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='Markdown')
+    
+    bot.answer_callback_query(call.id)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('favrm_'))
+def favorites_remove_callback(call):
+    _, book_id, page = call.data.split('_', 2)
+    
+    if not remove_from_favorites(call.from_user.id, int(book_id)):
+        bot.answer_callback_query(call.id, "Xatolik yuz berdi.")
+        return
+    
+    # Redraw the same page without the removed book
+    call.data = f"favpage_{page}"
+    favorites_page_callback(call)
 
 @bot.message_handler(func=lambda message: message.text == '📊 Statistika')
 def statistics_command(message):
@@ -594,8 +2705,72 @@ def statistics_command(message):
         category_name = category if category else "Kategoriyasiz"
         text += f"{category_name}: {count} ta\n"
     
+    text += f"\n📈 *So'nggi {STATS_TREND_DAYS} kun:*\n"
+    for day, new_users, new_books, new_ratings in stats['daily']:
+        text += f"{day}: +{new_users} foydalanuvchi, +{new_books} kitob, +{new_ratings} baho\n"
+    if not stats['daily']:
+        text += "Yangi faoliyat yo'q\n"
+    
+    if stats['refreshed_at']:
+        text += f"\n_TOP va kategoriyalar {stats['refreshed_at']} holatiga ko'ra_"
+    
     bot.send_message(message.chat.id, text, parse_mode='Markdown')
 
+# Superadmin users browser, a page at a time with a role filter
+USERS_PAGE_SIZE = 10
+USER_ROLE_FILTERS = [('all', "Hammasi"), ('user', "Foydalanuvchilar"), ('admin', "Adminlar"), ('superadmin', "Superadminlar")]
+
+def render_users_page(role, page='top'):
+    """Return (text, markup) for a page of the users browser; role is 'all' or a role name."""
+    role_filter = None if role == 'all' else role
+    count = count_users(role_filter)
+    users, has_newer, has_older = get_users_page(role_filter, limit=USERS_PAGE_SIZE, **_parse_keyset_page(page))
+    if not users and page != 'top':
+        page = 'top'
+        users, has_newer, has_older = get_users_page(role_filter, limit=USERS_PAGE_SIZE)
+
+    text = f"👥 *Foydalanuvchilar:* {count} ta\n\n"
+    for user in users:
+        name = f"{user['first_name'] or ''} {user['last_name'] or ''}".strip()
+        username = f"@{user['username']}" if user['username'] else "username yo'q"
+        text += f"{escape_markdown(name)} ({escape_markdown(username)}) — ID: {user['user_id']}\n" \
+                f"    {user['role']}, {user['registration_date']}\n"
+    if not users:
+        text += "Foydalanuvchilar topilmadi.\n"
+
+    markup = types.InlineKeyboardMarkup()
+    markup.row(*[
+        types.InlineKeyboardButton(f"✅ {label}" if key == role else label, callback_data=f"users_{key}_top")
+        for key, label in USER_ROLE_FILTERS
+    ])
+
+    navigation = []
+    if has_newer:
+        navigation.append(types.InlineKeyboardButton("◀", callback_data=f"users_{role}_n_{_keyset_key(users[0]['registration_date'], users[0]['user_id'])}"))
+    if has_older:
+        navigation.append(types.InlineKeyboardButton("▶", callback_data=f"users_{role}_o_{_keyset_key(users[-1]['registration_date'], users[-1]['user_id'])}"))
+    if navigation:
+        markup.row(*navigation)
+
+    markup.add(types.InlineKeyboardButton("📥 CSV yuklab olish", callback_data="users_export"))
+
+    return text, markup
+
+# Helper function to send the whole users table as a CSV document
+# Rows are streamed from the database into a temporary file, so the table is
+# never held in memory.
+def send_users_csv(chat_id):
+    with tempfile.TemporaryFile() as file:
+        writer_file = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+        writer = csv.writer(writer_file)
+        writer.writerow(['user_id', 'username', 'first_name', 'last_name', 'role', 'registration_date'])
+        writer.writerows(iter_users())
+        writer_file.flush()
+        writer_file.detach()
+
+        file.seek(0)
+        bot.send_document(chat_id, file, visible_file_name=f"users_{datetime.datetime.now():%Y%m%d}.csv")
+
 @bot.message_handler(func=lambda message: message.text == '👥 Foydalanuvchilar')
 def users_command(message):
     user_id = message.from_user.id
@@ -605,22 +2780,24 @@ def users_command(message):
         bot.send_message(message.chat.id, "Bu funksiya faqat superadmin uchun mavjud.")
         return
     
-    users = get_all_users()
+    text, markup = render_users_page('all')
+    bot.send_message(message.chat.id, text, reply_markup=markup, parse_mode='Markdown')
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('users_'))
+def users_page_callback(call):
+    if get_user_role(call.from_user.id) != 'superadmin':
+        bot.answer_callback_query(call.id, "Bu funksiya faqat superadmin uchun mavjud.")
+        return
     
-    text = "👥 *Foydalanuvchilar ro'yxati:*\n\n"
-    for user in users:
-        text += f"ID: {user['user_id']}\n" \
-               f"Username: @{user['username'] if user['username'] else 'mavjud emas'}\n" \
-               f"Ism: {user['first_name']} {user['last_name'] if user['last_name'] else ''}\n" \
-               f"Roli: {user['role']}\n" \
-               f"Ro'yxatdan o'tgan: {user['registration_date']}\n\n"
-    
-    # Send in chunks if text is too long
-    if len(text) > 4096:
-        for x in range(0, len(text), 4096):
-            bot.send_message(message.chat.id, text[x:x+4096], parse_mode='Markdown')
-    else:
-        bot.send_message(message.chat.id, text, parse_mode='Markdown')
+    if call.data == 'users_export':
+        bot.answer_callback_query(call.id, "Fayl tayyorlanmoqda...")
+        send_users_csv(call.message.chat.id)
+        return
+    
+    _, role, page = call.data.split('_', 2)
+    text, markup = render_users_page(role, page)
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='Markdown')
+    bot.answer_callback_query(call.id)
 
 @bot.message_handler(func=lambda message: message.text == '👤 Admin boshqarish')
 def manage_admins_command(message):
@@ -678,18 +2855,8 @@ def process_book_image(message, user_data):
     if message.content_type == 'photo':
         # Get the largest photo
         file_id = message.photo[-1].file_id
-        file_info = bot.get_file(file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
         
-        # Save the file
-        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        filename = f"{timestamp}_{message.chat.id}.jpg"
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], 'images', filename)
-        
-        with open(image_path, 'wb') as new_file:
-            new_file.write(downloaded_file)
-        
-        user_data['image_path'] = image_path
+        user_data['image_path'] = store_telegram_file(file_id, 'images')
     else:
         user_data['image_path'] = None
     
@@ -699,16 +2866,12 @@ def process_book_image(message, user_data):
 def process_book_pdf(message, user_data):
     if message.content_type == 'document' and message.document.mime_type == 'application/pdf':
         file_id = message.document.file_id
-        file_info = bot.get_file(file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
+        pdf_path = store_telegram_file(file_id, 'books')
         
-        # Save the file
-        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        filename = f"{timestamp}_{message.chat.id}.pdf"
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'books', filename)
-        
-        with open(pdf_path, 'wb') as new_file:
-            new_file.write(downloaded_file)
+        if not pdf_path:
+            bot.send_message(message.chat.id, "Faylni yuklab olishda xatolik yuz berdi. Iltimos, qaytadan yuboring.")
+            bot.register_next_step_handler(message, process_book_pdf, user_data)
+            return
         
         user_data['pdf_path'] = pdf_path
         
@@ -724,6 +2887,8 @@ def process_book_pdf(message, user_data):
         )
         
         if success:
+            schedule_pdf_indexing(book_id, pdf_path)
+            schedule_previews(book_id, user_data['image_path'], pdf_path)
             bot.send_message(message.chat.id, f"Kitob muvaffaqiyatli qo'shildi! Kitob ID: {book_id}")
         else:
             bot.send_message(message.chat.id, "Kitobni qo'shishda xatolik yuz berdi.")
@@ -735,23 +2900,12 @@ def process_book_pdf(message, user_data):
 @bot.callback_query_handler(func=lambda call: call.data.startswith('book_'))
 def book_callback(call):
     book_id = int(call.data.split('_')[1])
-    book = get_book_by_id(book_id)
+    book, text = get_book_with_caption(book_id)
     
     if not book:
         bot.answer_callback_query(call.id, "Kitob topilmadi.")
         return
     
-    # Get ratings
-    ratings = get_book_ratings(book_id)
-    avg_rating = sum(r['rating'] for r in ratings) / len(ratings) if ratings else 0
-    
-    # Create detailed book info text
-    text = f"📚 *{book['title']}*\n\n" \
-           f"👤 *Muallif:* {book['author']}\n" \
-           f"🔖 *Kategoriya:* {book['category']}\n" \
-           f"⭐ *Reyting:* {avg_rating:.1f} ({len(ratings)} baholash)\n\n" \
-           f"📝 *Tavsif:*\n{book['description']}\n\n"
-    
     # Create inline keyboard
     markup = types.InlineKeyboardMarkup()
     if book['pdf_path'] and os.path.exists(book['pdf_path']):
@@ -767,22 +2921,34 @@ def book_callback(call):
         markup.add(types.InlineKeyboardButton("✏️ Tahrirlash", callback_data=f"edit_{book_id}"))
         markup.add(types.InlineKeyboardButton("🗑️ O'chirish", callback_data=f"delete_{book_id}"))
     
-    # Edit message if it has an image, otherwise send new message
-    if book['image_path'] and os.path.exists(book['image_path']):
-        try:
-            with open(book['image_path'], 'rb') as photo:
-                bot.edit_message_media(
+    bot.answer_callback_query(call.id)
+    
+    # The resized preview is sent when there is one, the cover as uploaded otherwise
+    if book['preview_path'] and os.path.exists(book['preview_path']):
+        cover = 'preview'
+    elif book['image_path'] and os.path.exists(book['image_path']):
+        cover = 'image'
+    else:
+        cover = None
+    
+    # Result lists stay in place; a photo card is replaced by the details
+    if cover:
+        # Callbacks on old messages carry an InaccessibleMessage without content
+        if getattr(call.message, 'content_type', None) == 'photo':
+            try:
+                send_book_file(book, cover, lambda photo: bot.edit_message_media(
                     types.InputMediaPhoto(photo, caption=text, parse_mode='Markdown'),
                     call.message.chat.id,
-                    call.message.message_id
-                )
-                bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=markup)
-        except Exception as e:
-            logger.error(f"Error editing message: {e}")
-            with open(book['image_path'], 'rb') as photo:
-                bot.send_photo(call.message.chat.id, photo, caption=text, reply_markup=markup, parse_mode='Markdown')
+                    call.message.message_id,
+                    reply_markup=markup
+                ))
+                return
+            except Exception as e:
+                logger.error(f"Error editing message: {e}")
+        send_book_file(book, cover, lambda photo: bot.send_photo(
+            call.message.chat.id, photo, caption=text, reply_markup=markup, parse_mode='Markdown'))
     else:
-        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='Markdown')
+        bot.send_message(call.message.chat.id, text, reply_markup=markup, parse_mode='Markdown')
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('download_'))
 def download_callback(call):
@@ -794,8 +2960,8 @@ def download_callback(call):
         return
     
     # Send the file
-    with open(book['pdf_path'], 'rb') as file:
-        bot.send_document(call.message.chat.id, file, caption=f"📚 {book['title']} - {book['author']}")
+    send_book_file(book, 'pdf', lambda document: bot.send_document(
+        call.message.chat.id, document, caption=f"📚 {book['title']} - {book['author']}"))
     
     bot.answer_callback_query(call.id)
 
@@ -804,12 +2970,14 @@ def favorite_callback(call):
     book_id = int(call.data.split('_')[1])
     user_id = call.from_user.id
     
-    success = add_to_favorites(user_id, book_id)
+    success, added = add_to_favorites(user_id, book_id)
     
-    if success:
+    if not success:
+        bot.answer_callback_query(call.id, "Xatolik yuz berdi.")
+    elif added:
         bot.answer_callback_query(call.id, "Kitob sevimlilar ro'yxatiga qo'shildi!")
     else:
-        bot.answer_callback_query(call.id, "Xatolik yuz berdi yoki kitob allaqachon sevimlilar ro'yxatida.")
+        bot.answer_callback_query(call.id, "Kitob allaqachon sevimlilar ro'yxatida.")
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('remove_favorite_'))
 def remove_favorite_callback(call):
@@ -852,40 +3020,33 @@ def process_rating_comment(message, book_id, rating):
     user_id = message.from_user.id
     comment = message.text if message.text.lower() != "yo'q" else ""
     
-    success = add_rating(user_id, book_id, rating, comment)
+    success, created = add_rating(user_id, book_id, rating, comment)
     
-    if success:
+    if success and created:
         bot.send_message(message.chat.id, "Rahmat! Sizning bahoyingiz qabul qilindi.")
+    elif success:
+        bot.send_message(message.chat.id, "Rahmat! Sizning bahoyingiz yangilandi.")
     else:
         bot.send_message(message.chat.id, "Xatolik yuz berdi. Iltimos, keyinroq qayta urinib ko'ring.")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('category_'))
+@bot.callback_query_handler(func=lambda call: call.data.startswith(('cat_', 'category_')))
 def category_callback(call):
-    category = call.data.split('_', 1)[1]
-    books = get_books_by_category(category)
+    prefix, category = call.data.split('_', 1)
+    if prefix == 'cat':
+        category_id = int(category) if category.isdigit() else None
+    else:
+        # Menus sent before categories had ids carry the name instead
+        category_id = get_category_id(category)
+    page = render_results_page(save_result_list('category', category_id), 0) if category_id else None
     
-    if not books:
-        bot.answer_callback_query(call.id, f"{category} kategoriyasida kitoblar topilmadi.")
+    if not page:
+        bot.answer_callback_query(call.id, "Bu kategoriyada kitoblar topilmadi.")
         return
     
     bot.answer_callback_query(call.id)
     
-    # Send message with category name
-    bot.send_message(call.message.chat.id, f"📚 *{category}* kategoriyasidagi kitoblar:", parse_mode='Markdown')
-    
-    for book in books[:10]:  # Limit to 10 results
-        # Create inline keyboard for each book
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("Batafsil", callback_data=f"book_{book['id']}"))
-        
-        # Send book info
-        caption = f"📚 *{book['title']}*\n👤 *Muallif:* {book['author']}"
-        
-        if book['image_path'] and os.path.exists(book['image_path']):
-            with open(book['image_path'], 'rb') as photo:
-                bot.send_photo(call.message.chat.id, photo, caption=caption, reply_markup=markup, parse_mode='Markdown')
-        else:
-            bot.send_message(call.message.chat.id, caption, reply_markup=markup, parse_mode='Markdown')
+    text, markup = page
+    bot.send_message(call.message.chat.id, text, reply_markup=markup, parse_mode='Markdown')
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('edit_'))
 def edit_book_callback(call):
@@ -1011,14 +3172,8 @@ def process_edit_image(message, book_id):
         photo = message.photo[-1]
         file_id = photo.file_id
         
-        # Download the file
-        file_info = bot.get_file(file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        
         # Save the file and update the book record
-        file_path = os.path.join(UPLOAD_FOLDER, 'images', f"{book_id}.jpg")
-        with open(file_path, 'wb') as new_file:
-            new_file.write(downloaded_file)
+        file_path = store_telegram_file(file_id, 'images')
             
         update_book_field(book_id, 'image_path', file_path)
         bot.send_message(message.chat.id, "Kitob rasmi muvaffaqiyatli o'zgartirildi!")
@@ -1030,14 +3185,8 @@ def process_edit_pdf(message, book_id):
     if message.document and message.document.mime_type == 'application/pdf':
         file_id = message.document.file_id
         
-        # Download the file
-        file_info = bot.get_file(file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        
         # Save the file and update the book record
-        file_path = os.path.join(UPLOAD_FOLDER, 'books', f"{book_id}.pdf")
-        with open(file_path, 'wb') as new_file:
-            new_file.write(downloaded_file)
+        file_path = store_telegram_file(file_id, 'books')
             
         update_book_field(book_id, 'pdf_path', file_path)
         bot.send_message(message.chat.id, "Kitob PDF fayli muvaffaqiyatli o'zgartirildi!")
@@ -1072,13 +3221,7 @@ def set_category_callback(call):
         bot.answer_callback_query(call.id, "Kategoriya muvaffaqiyatli o'zgartirildi!")
         
         # Show book edit menu again
-        edit_callback_data = f"edit_{book_id}"
-        edit_book_callback(types.CallbackQuery(
-            id=call.id,
-            from_user=call.from_user,
-            data=edit_callback_data,
-            message=call.message
-        ))
+        show_book_after_edit(call.message.chat.id, book_id)
     else:
         bot.answer_callback_query(call.id, "Noto'g'ri format.")
 
@@ -1214,24 +3357,13 @@ def process_edit_image(message, book_id):
     
     # Get the largest photo
     file_id = message.photo[-1].file_id
-    file_info = bot.get_file(file_id)
-    downloaded_file = bot.download_file(file_info.file_path)
-    
-    # Save the file
-    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-    filename = f"{timestamp}_{message.chat.id}.jpg"
-    image_path = os.path.join(app.config['UPLOAD_FOLDER'], 'images', filename)
+    image_path = store_telegram_file(file_id, 'images')
     
-    with open(image_path, 'wb') as new_file:
-        new_file.write(downloaded_file)
-    
-    # Delete old image if exists
-    if book['image_path'] and os.path.exists(book['image_path']):
-        try:
-            os.remove(book['image_path'])
-        except Exception as e:
-            logger.error(f"Error deleting old image: {e}")
+    if not image_path:
+        bot.send_message(message.chat.id, "Xatolik yuz berdi. Iltimos, keyinroq qayta urinib ko'ring.")
+        return
     
+    # The old image is removed once no book uses it
     success = update_book(
         book_id,
         book['title'],
@@ -1243,6 +3375,7 @@ def process_edit_image(message, book_id):
     )
     
     if success:
+        schedule_previews(book_id, image_path, book['pdf_path'])
         bot.send_message(message.chat.id, "Kitob rasmi yangilandi.")
     else:
         bot.send_message(message.chat.id, "Xatolik yuz berdi. Iltimos, keyinroq qayta urinib ko'ring.")
@@ -1266,24 +3399,13 @@ def process_edit_pdf(message, book_id):
         return
     
     file_id = message.document.file_id
-    file_info = bot.get_file(file_id)
-    downloaded_file = bot.download_file(file_info.file_path)
-    
-    # Save the file
-    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-    filename = f"{timestamp}_{message.chat.id}.pdf"
-    pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'books', filename)
-    
-    with open(pdf_path, 'wb') as new_file:
-        new_file.write(downloaded_file)
+    pdf_path = store_telegram_file(file_id, 'books')
     
-    # Delete old PDF if exists
-    if book['pdf_path'] and os.path.exists(book['pdf_path']):
-        try:
-            os.remove(book['pdf_path'])
-        except Exception as e:
-            logger.error(f"Error deleting old PDF: {e}")
+    if not pdf_path:
+        bot.send_message(message.chat.id, "Xatolik yuz berdi. Iltimos, keyinroq qayta urinib ko'ring.")
+        return
     
+    # The old PDF is removed once no book uses it
     success = update_book(
         book_id,
         book['title'],
@@ -1295,6 +3417,8 @@ def process_edit_pdf(message, book_id):
     )
     
     if success:
+        schedule_pdf_indexing(book_id, pdf_path)
+        schedule_previews(book_id, book['image_path'], pdf_path)
         bot.send_message(message.chat.id, "Kitob PDF fayli yangilandi.")
     else:
         bot.send_message(message.chat.id, "Xatolik yuz berdi. Iltimos, keyinroq qayta urinib ko'ring.")
@@ -1364,13 +3488,7 @@ def process_add_admin(message):
         user_id = int(message.text.strip())
         
         # Check if user exists
-        conn = sqlite3.connect('library.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        user = cursor.fetchone()
-        conn.close()
-        
-        if not user:
+        if not user_exists(user_id):
             bot.send_message(message.chat.id, "Foydalanuvchi topilmadi. Iltimos, foydalanuvchi botda ro'yxatdan o'tganligini tekshiring.")
             return
         
@@ -1393,11 +3511,7 @@ def remove_admin_callback(call):
         return
     
     # Get all admins
-    conn = sqlite3.connect('library.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, username, first_name, last_name FROM users WHERE role = 'admin'")
-    admins = cursor.fetchall()
-    conn.close()
+    admins = get_admins()
     
     if not admins:
         bot.send_message(call.message.chat.id, "Adminlar topilmadi.")
@@ -1426,40 +3540,257 @@ def remove_admin_user_callback(call):
     
     bot.answer_callback_query(call.id)
 
+# Update ingestion
+# Incoming updates are queued and handled by a pool of workers. Updates are
+# sharded by chat id, so one chat is always served by the same worker and its
+# next-step handlers see messages in order. Each shard queue is bounded; when
+# it is full the update is refused and Telegram redelivers it later.
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 4))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 256))
+# 'memory' dedupes within this process; 'sqlite' also across processes
+UPDATE_DEDUPE_BACKEND = os.environ.get('UPDATE_DEDUPE_BACKEND', 'memory')
+UPDATE_DEDUPE_WINDOW = int(os.environ.get('UPDATE_DEDUPE_WINDOW', 10000))
+
+_update_queues = []
+_update_workers_lock = threading.Lock()
+_update_metrics = {'enqueued': 0, 'processed': 0, 'failed': 0, 'rejected': 0, 'duplicates': 0, 'max_depth': 0}
+_update_metrics_lock = threading.Lock()
+_seen_update_ids = set()
+_seen_update_order = collections.deque()
+_seen_updates_lock = threading.Lock()
+
+def _count_update(key, amount=1):
+    with _update_metrics_lock:
+        _update_metrics[key] += amount
+
+def _update_chat_id(update):
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in update:
+            return update[key]['chat']['id']
+
+    callback = update.get('callback_query')
+    if callback:
+        if callback.get('message'):
+            return callback['message']['chat']['id']
+        return callback['from']['id']
+
+    for value in update.values():
+        if isinstance(value, dict):
+            if 'chat' in value:
+                return value['chat']['id']
+            if 'from' in value:
+                return value['from']['id']
+
+    return update['update_id']
+
+# Update deduplication
+# Telegram redelivers an update when our reply is slow or fails, so every
+# update_id is remembered for a window and repeats are dropped before any
+# handler runs.
+def _mark_update_seen_sqlite(update_id):
+    def write(cursor):
+        cursor.execute("INSERT OR IGNORE INTO processed_updates (update_id) VALUES (?)", (update_id,))
+        inserted = cursor.rowcount == 1
+        if inserted and update_id % 1000 == 0:
+            cursor.execute("DELETE FROM processed_updates WHERE update_id < ?", (update_id - UPDATE_DEDUPE_WINDOW,))
+        return inserted
+
+    try:
+        return run_write(write)
+    except sqlite3.Error as e:
+        # Better to risk a duplicate than to lose the update
+        logger.error(f"Database error: {e}")
+        return True
+
+def mark_update_seen(update_id):
+    """Remember update_id; False if it was already seen."""
+    with _seen_updates_lock:
+        if update_id in _seen_update_ids:
+            return False
+        _seen_update_ids.add(update_id)
+        _seen_update_order.append(update_id)
+        if len(_seen_update_order) > UPDATE_DEDUPE_WINDOW:
+            _seen_update_ids.discard(_seen_update_order.popleft())
+
+    if UPDATE_DEDUPE_BACKEND == 'sqlite' and not _mark_update_seen_sqlite(update_id):
+        return False
+
+    return True
+
+def forget_update(update_id):
+    with _seen_updates_lock:
+        _seen_update_ids.discard(update_id)
+
+    if UPDATE_DEDUPE_BACKEND == 'sqlite':
+        def write(cursor):
+            cursor.execute("DELETE FROM processed_updates WHERE update_id = ?", (update_id,))
+
+        try:
+            run_write(write)
+        except sqlite3.Error as e:
+            logger.error(f"Database error: {e}")
+
+def _update_worker(updates):
+    while True:
+        update = updates.get()
+        try:
+            bot.process_new_updates([telebot.types.Update.de_json(update)])
+            _count_update('processed')
+        except Exception as e:
+            logger.error(f"Error processing update {update.get('update_id')}: {e}")
+            _count_update('failed')
+
+def start_update_workers():
+    with _update_workers_lock:
+        if _update_queues:
+            return
+        for i in range(UPDATE_WORKERS):
+            updates = queue.Queue(maxsize=UPDATE_QUEUE_SIZE)
+            threading.Thread(target=_update_worker, args=(updates,), name=f'update-worker-{i}', daemon=True).start()
+            _update_queues.append(updates)
+
+def enqueue_update(update):
+    """Queue a raw update dict for processing; False if its shard is full."""
+    if not _update_queues:
+        start_update_workers()
+
+    if not mark_update_seen(update['update_id']):
+        # Already accepted once; acknowledge the retry without handling it again
+        _count_update('duplicates')
+        return True
+
+    updates = _update_queues[_update_chat_id(update) % len(_update_queues)]
+    try:
+        updates.put_nowait(update)
+    except queue.Full:
+        forget_update(update['update_id'])
+        _count_update('rejected')
+        logger.warning(f"Update queue full, rejecting update {update['update_id']}")
+        return False
+
+    depth = updates.qsize()
+    with _update_metrics_lock:
+        _update_metrics['enqueued'] += 1
+        _update_metrics['max_depth'] = max(_update_metrics['max_depth'], depth)
+    return True
+
+def get_update_metrics():
+    with _update_metrics_lock:
+        metrics = dict(_update_metrics)
+    metrics['queue_depths'] = [updates.qsize() for updates in _update_queues]
+    return metrics
+
+def run_polling():
+    bot.remove_webhook()
+    offset = None
+
+    while True:
+        try:
+            updates = telebot.apihelper.get_updates(BOT_TOKEN, offset=offset, timeout=30, long_polling_timeout=25)
+        except Exception as e:
+            logger.error(f"Error getting updates: {e}")
+            time.sleep(3)
+            continue
+
+        for update in updates:
+            # Wait for room instead of dropping: there is no redelivery in polling mode
+            while not enqueue_update(update):
+                time.sleep(0.5)
+            offset = update['update_id'] + 1
+
 # Flask routes for webhook
 @app.route(f'/{BOT_TOKEN}', methods=['POST'])
 def webhook():
-    json_str = request.get_data().decode('UTF-8')
-    update = telebot.types.Update.de_json(json_str)
-    bot.process_new_updates([update])
+    update = request.get_json(silent=True)
+    if not isinstance(update, dict) or 'update_id' not in update:
+        return 'Bad Request', 400
+
+    if not enqueue_update(update):
+        return 'Busy', 503
+
     return 'OK'
 
-@app.route('/uploads/books/<filename>')
+# Operational counters are only served with METRICS_TOKEN as a bearer token;
+# without one configured the endpoint is off.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+@app.route('/metrics')
+def metrics():
+    if not METRICS_TOKEN:
+        return 'Not Found', 404
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return 'Unauthorized', 401
+
+    return jsonify({
+        'updates': get_update_metrics(),
+        'book_cache': get_book_cache_metrics(),
+        'outbound': get_send_metrics()
+    })
+
+@app.route('/uploads/books/<path:filename>')
 def serve_book(filename):
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], 'books', filename))
+    return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], 'books'), filename)
 
-@app.route('/uploads/images/<filename>') 
+@app.route('/uploads/images/<path:filename>')
 def serve_image(filename):
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], 'images', filename))
+    return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], 'images'), filename)
+
+@app.route('/uploads/previews/<path:filename>')
+def serve_preview(filename):
+    return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], 'previews'), filename)
 
 # Initialize database and set webhook
-@app.before_request
-def setup():
-    init_db()
-    # Set webhook
+# Runs once per process: on the first request, or ahead of time via `flask --app main init`.
+_started = False
+_startup_lock = threading.Lock()
+
+def register_webhook():
+    # Only talk to set_webhook when Telegram has a different URL on record
     try:
-        bot.remove_webhook()
-        bot.set_webhook(url=f"https://your-server-domain.com/{BOT_TOKEN}")
+        if bot.get_webhook_info().url == WEBHOOK_URL:
+            return False
+        bot.set_webhook(url=WEBHOOK_URL)
+        logger.info("Webhook registered")
+        return True
     except Exception as e:
         logger.error(f"Error setting webhook: {e}")
+        return False
+
+def start_background_workers():
+    # Only for processes that serve updates; one-off commands must not
+    # leave pools and threads behind
+    resume_pdf_indexing()
+    resume_previews()
+    start_stats_refresher()
+
+def startup():
+    global _started
+    with _startup_lock:
+        if _started:
+            return
+        init_db()
+        register_webhook()
+        start_background_workers()
+        _started = True
+
+@app.before_request
+def setup():
+    if not _started:
+        startup()
+
+@app.cli.command('init')
+def init_command():
+    """Initialize the database and register the webhook."""
+    init_db()
+    register_webhook()
 
 if __name__ == '__main__':
     # Initialize database
     init_db()
+    start_background_workers()
     
     
-    bot.remove_webhook()
-    bot.polling(none_stop=True)
+    run_polling()
     
     
     # app.run(host='0.0.0.0', port=8443, debug=True)
\ No newline at end of file
@@ -0,0 +1,139 @@
+"""Bot API calls against a local fake server: connections are pooled,
+per-call latency stays low and uploads go through the file session."""
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+os.environ.setdefault('LIBRARY_DB', os.path.join(tempfile.mkdtemp(), 'library.db'))
+
+import telebot  # noqa: E402
+import main  # noqa: E402
+
+# Generous for a loopback round trip through the scheduler, but well below
+# the ~40 ms a Nagle/delayed-ACK stall adds to every call
+MAX_CALL_LATENCY = 0.02
+
+MESSAGE = {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}}
+
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately; don't let Nagle hold the body
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.calls.append((self.path.rsplit('/', 1)[-1], self.client_address))
+
+        body = json.dumps({'ok': True, 'result': MESSAGE}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api_server(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotAPI)
+    server.calls = []
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    monkeypatch.setattr(telebot.apihelper, 'API_URL', f"http://127.0.0.1:{server.server_port}/bot{{0}}/{{1}}")
+    # Rate limits are not under test here
+    monkeypatch.setattr(main, 'SEND_CHAT_RATE', 1000)
+    monkeypatch.setattr(main, 'SEND_CHAT_BURST', 1000)
+    monkeypatch.setattr(main, '_send_chat_buckets', {})
+    monkeypatch.setattr(main, '_send_global_bucket', main.TokenBucket(1000, 1000))
+
+    # Start from empty pools so connections opened by other tests don't count
+    monkeypatch.setattr(main, '_api_session', main._pooled_session(main.API_POOL_SIZE))
+    monkeypatch.setattr(main, '_file_session', main._pooled_session(main.FILE_POOL_SIZE))
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def connections(server, method=None):
+    return {address for name, address in server.calls if method is None or name == method}
+
+
+def test_sequential_calls_reuse_one_connection(api_server):
+    for _ in range(50):
+        main.bot.send_message(1, 'hello')
+
+    assert len(api_server.calls) == 50
+    assert len(connections(api_server)) == 1
+
+
+def test_per_call_latency(api_server, record_property):
+    main.bot.send_message(1, 'warm up')
+
+    timings = []
+    for _ in range(100):
+        started = time.perf_counter()
+        main.bot.send_message(1, 'hello')
+        timings.append(time.perf_counter() - started)
+
+    timings.sort()
+    median = timings[len(timings) // 2]
+    p95 = timings[int(len(timings) * 0.95)]
+    record_property('median_call_ms', round(median * 1000, 2))
+    record_property('p95_call_ms', round(p95 * 1000, 2))
+    print(f"send_message latency: median {median * 1000:.2f} ms, p95 {p95 * 1000:.2f} ms")
+
+    assert median < MAX_CALL_LATENCY
+
+
+def test_concurrent_calls_stay_within_pool(api_server):
+    def send(chat_id):
+        for _ in range(25):
+            main.bot.send_message(chat_id, 'hello')
+
+    threads = [threading.Thread(target=send, args=(chat_id,)) for chat_id in range(1, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(api_server.calls) == 200
+    assert len(connections(api_server)) <= main.API_POOL_SIZE
+
+
+def test_upload_uses_file_session(api_server, monkeypatch):
+    file_requests = []
+    file_request = main._file_session.request
+
+    def record(method, url, **kwargs):
+        file_requests.append(url.rsplit('/', 1)[-1])
+        return file_request(method, url, **kwargs)
+
+    monkeypatch.setattr(main._file_session, 'request', record)
+
+    main.bot.send_message(1, 'hello')
+    main.bot.send_document(1, io.BytesIO(b'%PDF-1.4\n' * 1000), visible_file_name='book.pdf')
+
+    assert file_requests == ['sendDocument']
+    assert connections(api_server, 'sendDocument').isdisjoint(connections(api_server, 'sendMessage'))